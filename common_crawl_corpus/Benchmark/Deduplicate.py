@@ -3,6 +3,8 @@ import pandas as pd
 import glob
 import time
 
+from common_crawl_corpus.hashing import line_hash
+
 tqdm.pandas(ncols=70)
 
 """You will need to download the segment from the first index (idealy around 250 instance) and used WET processor to 
@@ -16,7 +18,7 @@ for i, filename in enumerate(tqdm(top_files)):
     if i > 100 and i % 3 != 0:
         continue
     temp_df = pd.read_pickle(filename, compression="gzip")
-    temp_df["Hash"] = temp_df["Text"].apply(hash)
+    temp_df["Hash"] = temp_df["Text"].apply(line_hash)
 
     concats.append(temp_df)
     df = pd.concat(concats, ignore_index=True)
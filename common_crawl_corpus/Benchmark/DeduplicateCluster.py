@@ -0,0 +1,44 @@
+import random
+import string
+import tempfile
+import time
+
+import numpy as np
+
+from common_crawl_corpus.deduplicator import Deduplicator
+
+"""Time of Deduplicator.deduplicate_cluster over a growing batch_size, and check that the lines it keeps do not depend
+on batch_size. The lines are random walks of small edits, so that chains of near-duplicates where A~B and B~C but
+not A~C are common: B is dropped for A, C is kept as it is only similar to a dropped line.
+    python -m common_crawl_corpus.Benchmark.DeduplicateCluster"""
+
+
+def random_walks(walks: int, steps: int, length: int = 200, edits: int = 12, seed: int = 1):
+    generator = random.Random(seed)
+    lines = []
+    for walk in range(walks):
+        line = "".join(generator.choices(string.ascii_lowercase + " ", k=length))
+        for step in range(steps):
+            lines.append(line)
+            characters = list(line)
+            for edit in range(edits):
+                characters[generator.randrange(length)] = generator.choice(string.ascii_lowercase)
+            line = "".join(characters)
+    generator.shuffle(lines)
+    return lines
+
+
+if __name__ == "__main__":
+    lines = random_walks(walks=100, steps=10)
+    reference = None
+    for batch_size in [1, 7, 100, 2 ** 16]:
+        with tempfile.TemporaryDirectory() as index_dir:
+            deduplicator = Deduplicator(index_dir)
+            start = time.time()
+            # Two shards, so that lines are also checked against the index of the shard before
+            keep = np.concatenate([deduplicator.deduplicate_cluster(lines[:len(lines) // 2], "first", batch_size),
+                                   deduplicator.deduplicate_cluster(lines[len(lines) // 2:], "second", batch_size)])
+            print(f"batch_size {batch_size:>6}: {time.time() - start:.2f}s, kept {keep.sum()} of {len(lines)} lines")
+        if reference is None:
+            reference = keep
+        assert (keep == reference).all(), f"batch_size {batch_size} keeps other lines than batch_size 1"
@@ -0,0 +1,104 @@
+import logging
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from common_crawl_corpus import downloader as downloader_module
+from common_crawl_corpus.downloader import Downloader
+
+"""Check of the Downloader against a local stand-in for Common Crawl that fails on purpose: files are served by
+http.server with Range support, some paths answer 503 on every other request, drop the connection after a part of
+the body, or ignore the Range header and drop every other connection. Every way of reading a file (get, open,
+download, and download resuming a .part file) must give the same bytes as the file served.
+    python -m common_crawl_corpus.Benchmark.Downloader"""
+
+FILE_SIZE = 2 ** 22
+# Bytes sent before a connection is dropped
+DROP_AFTER = 300000
+FILES = {name: random.Random(name).randbytes(FILE_SIZE) for name in ["ok", "flaky", "dropped", "norange"]}
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests_seen = {}
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body: bool = True):
+        name = self.path.strip("/")
+        if name not in FILES:
+            self.send_error(404)
+            return
+        with self.lock:
+            seen = self.requests_seen[name] = self.requests_seen.get(name, 0) + 1
+        if name == "flaky" and seen % 2:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        data = FILES[name]
+        start = 0
+        range_header = self.headers.get("Range")
+        if range_header and name != "norange":
+            start = int(range_header.removeprefix("bytes=").rstrip("-"))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.send_header("ETag", f'"{name}"')
+        self.end_headers()
+        if not body:
+            return
+        if name == "dropped" or name == "norange" and seen % 2:
+            # Part of the body, then the connection goes away
+            self.wfile.write(data[start:start + DROP_AFTER])
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+            self.close_connection = True
+            return
+        self.wfile.write(data[start:])
+
+
+def read_stream(downloader: Downloader, name: str) -> bytes:
+    with downloader.open(name) as stream:
+        chunks = []
+        while chunk := stream.read(65536):
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+
+if __name__ == "__main__":
+    # Every retry logs a warning, the total is in the stats printed at the end
+    downloader_module.logger.setLevel(logging.ERROR)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    downloader = Downloader(f"http://127.0.0.1:{server.server_port}", retries=32, backoff=0.01, max_backoff=0.05)
+    with tempfile.TemporaryDirectory() as directory:
+        for name, data in FILES.items():
+            start = time.time()
+            assert downloader.size(name) == len(data), name
+            assert downloader.get(name) == data, f"get {name}"
+            assert read_stream(downloader, name) == data, f"open {name}"
+            destination = os.path.join(directory, name)
+            assert downloader.download(name, destination) == len(data), f"download {name}"
+            with open(destination, "rb") as file:
+                assert file.read() == data, f"download {name}"
+            # A download interrupted earlier, resumed from its .part file
+            with open(f"{destination}.resumed.part", "wb") as file:
+                file.write(data[:FILE_SIZE // 3])
+            downloader.download(name, f"{destination}.resumed")
+            with open(f"{destination}.resumed", "rb") as file:
+                assert file.read() == data, f"resumed download {name}"
+            print(f"{name:>8}: {time.time() - start:.2f}s, {FlakyHandler.requests_seen[name]} requests")
+    print(downloader.stats)
+    server.shutdown()
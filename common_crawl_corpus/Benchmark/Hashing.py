@@ -0,0 +1,38 @@
+import hashlib
+import sys
+import time
+
+from common_crawl_corpus.Benchmark.LineCleaner import read_lines
+from common_crawl_corpus.hashing import HASH_SIZE, hash_lines, line_hash, sha1_hash
+
+"""Throughput of the line hashes usable for the Hash column. Run with one or more local WET files:
+    python -m common_crawl_corpus.Benchmark.Hashing CC-MAIN-...warc.wet.gz
+hashing.line_hash (XXH3) is compared with the SHA-1 of the former deduplication.str_hash, BLAKE2b and the built-in
+hash(), which is fast but salted per process. Collisions are counted against the number of distinct lines."""
+
+
+def blake2b_hash(line):
+    return int.from_bytes(hashlib.blake2b(line.encode("utf-8"), digest_size=HASH_SIZE).digest(), byteorder="little")
+
+
+def timed(name, function, lines, distinct):
+    start = time.time()
+    hashes = function(lines)
+    total_time = time.time() - start
+    megabytes = sum(len(line.encode("utf-8")) for line in lines) / 2 ** 20
+    print(f"{name:>24}: {total_time:.3f}s, {len(lines) / total_time / 1e6:.2f}M lines/s, "
+          f"{megabytes / total_time:.0f}MB/s, {distinct - len(set(hashes))} collisions")
+
+
+if __name__ == "__main__":
+    # Repeat the lines to get a measurable amount of work out of small files, as new string objects since hash()
+    # caches its value on the string
+    lines = read_lines(sys.argv[1:])
+    lines = [line.encode("utf-8").decode("utf-8") for _ in range(max(1, 10 ** 6 // len(lines))) for line in lines]
+    distinct = len(set(lines))
+    print(f"{len(lines)} lines, {distinct} distinct")
+    timed("hash() (per process)", lambda lines: [hash(line) for line in lines], lines, distinct)
+    timed("SHA-1 (str_hash before)", lambda lines: [sha1_hash(line) for line in lines], lines, distinct)
+    timed("BLAKE2b-64", lambda lines: [blake2b_hash(line) for line in lines], lines, distinct)
+    timed("XXH3-64 line_hash", lambda lines: [line_hash(line) for line in lines], lines, distinct)
+    timed("XXH3-64 hash_lines", lambda lines: hash_lines(lines).tolist(), lines, distinct)
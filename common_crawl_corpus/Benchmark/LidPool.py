@@ -0,0 +1,36 @@
+import multiprocessing as mp
+import sys
+import time
+
+import numpy as np
+import pyarrow.compute as pc
+
+from common_crawl_corpus.corpus_store import read_batches
+from common_crawl_corpus.lid_pool import LidPool, detect_languages
+
+"""Time of CLD2/CLD3 identification of the lines of a corpus file, line by line on a new pool for each call as
+geoWAC used to do, and in batches on a persistent LidPool fed through shared memory. Needs cld2 and cld3, run
+with a corpus file (csv or parquet):
+    python -m common_crawl_corpus.Benchmark.LidPool europe_west.fr.fra.1.gz"""
+
+
+def detect_line(line):
+    return detect_languages([line])[0]
+
+
+if __name__ == "__main__":
+    lines = [line for batch in read_batches(sys.argv[1])
+             for line in pc.list_flatten(pc.split_pattern(batch.column("Text").fill_null(""), "\n")).to_pylist()]
+    workers = mp.cpu_count()
+    for run in range(3):
+        start = time.time()
+        with mp.Pool(processes=workers) as pool:
+            lines_codes = np.array(pool.map(detect_line, lines, chunksize=100))
+        print(f"   line by line: {time.time() - start:.2f}s, {len(lines)} lines")
+
+    with LidPool(workers=workers) as lid_pool:
+        for run in range(3):
+            start = time.time()
+            codes = lid_pool.detect(lines)
+            print(f"LidPool batches: {time.time() - start:.2f}s, {len(lines)} lines")
+    assert (codes == lines_codes).all()
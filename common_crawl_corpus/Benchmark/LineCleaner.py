@@ -0,0 +1,114 @@
+import collections
+import sys
+import time
+
+import warcio
+from alphabet_detector import AlphabetDetector
+from cytoolz import pipe, juxt
+from gensim.parsing import preprocessing
+
+from common_crawl_corpus import utilities
+from common_crawl_corpus.cleaning import LineCleaner
+
+"""Parity check and timing of cleaning.LineCleaner against the pipe() chain it replaced in
+CC_Corpus._process_wet_record. Run with one or more local WET files:
+    python -m common_crawl_corpus.Benchmark.LineCleaner CC-MAIN-...warc.wet.gz
+Every line of every conversion record, plus a set of edge cases, must give the same accepted line, both through
+LineCleaner.clean and through the batched LineCleaner.clean_batch."""
+
+alphabet_detector = AlphabetDetector()
+
+EDGE_CASES = [
+    "a@http1 b@c #x<y> and some more words to pass the length limit of the filter",
+    "<a href=http://example.com>link text</a> followed by a sentence long enough to keep",
+    "Visit http://foo.bar/baz and @user #tag <b>bold</b> the quick brown fox jumps over",
+    "emoji 😀 line with 👨‍👩‍👧 family and keycap #️⃣ and flags 🇫🇷 in a long enough sentence",
+    "これは日本語の文章です。とても長い行になります。",
+    "中文句子测试一下这个过滤器的效果如何呢",
+    "한국어 문장 테스트입니다 길이가 충분한가요",
+    "カタカナノミノギョウデスヨネコレハ",
+    "ひらがなだけのぎょうですよねこれは",
+    "1234 5678 90 12 34 56 78 90 12 34 56",
+    "abc123def456 ghi789 jkl 0mno pqr stu vwx yz and a few more words here",
+    "- - - - ( ( ( ( ) ) ) ) lines with too many symbols to be real text ok",
+    "price: 12.50 EUR .... ..... ...... ....... for the whole package of stuff",
+    "tab\tseparated\t\tvalues   with    many     spaces and enough length to count",
+    "Ünïcödé lïnë wïth äccents thät ïs löng ënöügh tö päss thë fïltër chëck ok",
+    "mixed 中文 and English text in one line which should use the long threshold",
+    "           ",
+    "short",
+]
+
+
+def legacy_clean(line):
+    """The former line filter of CC_Corpus._process_wet_record"""
+    if len(line) <= 15:
+        return None
+    line = pipe(line,
+                utilities.strip_tags,
+                utilities.remove_emoji,
+                preprocessing.strip_tags,
+                preprocessing.split_alphanum,
+                preprocessing.strip_multiple_whitespaces)
+    if len(line) <= 15 or any(char in line for char in utilities.ILLEGAL_CHAR):
+        return None
+    character_only = pipe(line, preprocessing.strip_numeric, preprocessing.strip_punctuation)
+    if len(character_only) <= 12:
+        return None
+    if any(juxt(alphabet_detector.is_cjk,
+                alphabet_detector.is_hangul,
+                alphabet_detector.is_hiragana,
+                alphabet_detector.is_katakana
+                )(line)):
+        length = 15
+    else:
+        length = 50
+    if len(line) < length:
+        return None
+    string_counter = collections.Counter(line)
+    if all([string_counter.get("-", 0) < 4, string_counter.get("(", 0) < 4, string_counter.get(")", 0) < 4,
+            string_counter.get("=", 0) < 2, string_counter.get("_", 0) < 2, string_counter.get(".", 0) < 15,
+            string_counter.get("&", 0) < 4, string_counter.get("[", 0) < 3, string_counter.get("]", 0) < 3,
+            string_counter.get("*", 0) < 5]):
+        return line
+    return None
+
+
+def read_lines(file_dirs):
+    lines = list(EDGE_CASES)
+    for file_dir in file_dirs:
+        with open(file_dir, "rb") as file:
+            for record in warcio.ArchiveIterator(file):
+                if record.rec_type == "conversion":
+                    lines.extend(record.content_stream().read().decode("utf-8").splitlines())
+    return lines
+
+
+if __name__ == "__main__":
+    lines = read_lines(sys.argv[1:])
+    line_cleaner = LineCleaner()
+
+    start = time.time()
+    expected = [legacy_clean(line) for line in lines]
+    legacy_time = time.time() - start
+
+    start = time.time()
+    result = [line_cleaner.clean(line) for line in lines]
+    cleaner_time = time.time() - start
+
+    start = time.time()
+    batch_result = [None] * len(lines)
+    for offset in range(0, len(lines), 4096):
+        positions, cleaned = line_cleaner.clean_batch(lines[offset:offset + 4096])
+        for position, line in zip(positions, cleaned):
+            batch_result[offset + position] = line
+    batch_time = time.time() - start
+
+    mismatched = [(line, old, new) for line, old, new in zip(lines, expected, result) if old != new]
+    mismatched += [(line, old, new) for line, old, new in zip(lines, expected, batch_result) if old != new]
+    for line, old, new in mismatched[:20]:
+        print(f"MISMATCH {line!r}\n\tlegacy:  {old!r}\n\tcleaner: {new!r}")
+    print(f"{len(lines)} lines, {sum(line is not None for line in expected)} accepted, {len(mismatched)} mismatched")
+    print(f"legacy chain: {legacy_time:.2f}s, LineCleaner: {cleaner_time:.2f}s, speed-up {legacy_time / cleaner_time:.1f}x")
+    print(f"LineCleaner.clean_batch: {batch_time:.2f}s, speed-up {legacy_time / batch_time:.1f}x")
+    sys.exit(1 if mismatched else 0)
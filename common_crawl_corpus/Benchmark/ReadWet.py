@@ -0,0 +1,33 @@
+import logging
+import multiprocessing as mp
+import sys
+import time
+
+from common_crawl_corpus import WET_processor
+
+"""Time of WET_processor.read_wet on a local WET file, through warcio and through the memory-mapped reader, in one
+process and split on its gzip members over a growing number of processes. Run with a local WET file:
+    python -m common_crawl_corpus.Benchmark.ReadWet CC-MAIN-...warc.wet.gz"""
+
+
+def timed(name, function):
+    start = time.time()
+    df = function()
+    print(f"{name:>12}: {time.time() - start:.2f}s, {len(df)} lines")
+    return df
+
+
+if __name__ == "__main__":
+    WET_processor.logger.setLevel(logging.WARNING)
+    is_gzip_file = WET_processor._is_gzip_file
+    path = sys.argv[1]
+    # Forcing the warcio path, as for a file that is not gzipped
+    WET_processor._is_gzip_file = lambda file_dir: False
+    timed("warcio", lambda: WET_processor.read_wet(path))
+    WET_processor._is_gzip_file = is_gzip_file
+    serial = timed("serial", lambda: WET_processor.read_wet(path))
+    workers = 2
+    while workers <= mp.cpu_count():
+        parallel = timed(f"{workers} workers", lambda: WET_processor.read_wet(path, workers=workers))
+        assert parallel.equals(serial)
+        workers *= 2
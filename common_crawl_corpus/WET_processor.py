@@ -1,15 +1,26 @@
-import re
+import mmap
+import multiprocessing as mp
+import os
 import warcio
+import numpy as np
 import pandas as pd
-from cytoolz import pipe, juxt
-from gensim.parsing import preprocessing
 from . import utilities
-from typing import Optional, List, Tuple
-from alphabet_detector import AlphabetDetector
-import collections
+from .cleaning import LineCleaner
+from .deduplicator import Deduplicator
+from .downloader import CC_BASE_URL, Downloader
+from .hashing import hash_lines, line_hash
+from .url_filter import UrlFilter
+from .wet_cache import WetCache
+from .wet_reader import GZIP_MAGIC, iter_records, member_ranges
+from contextlib import closing
+from typing import Iterator, Optional, List, Tuple, Union
 import logging
 
-alphabet_detector = AlphabetDetector()
+line_cleaner = LineCleaner()
+# utilities.URL_FILTER, compiled once
+mnc_filter = UrlFilter()
+# Local copy of the segments read_wet got from Common Crawl when it is not given one, set up by get_wet_cache
+wet_cache: Optional[WetCache] = None
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -21,89 +32,155 @@ logger.addHandler(ch)
 logger.debug('call to WET_processer')
 
 
-def read_wet(file_dir: str) -> pd.DataFrame:
-    """Save processed WET_record to list then save it to pickle file"""
-    # TODO: add multiprocessing for wet not wet record
+def get_wet_cache(download_dir: Union[str, os.PathLike] = "./common_crawl_download", base_url: str = CC_BASE_URL,
+                  max_bytes: Optional[int] = None) -> WetCache:
+    """The cache of read_wet when it is not given one: download_dir/wet_cache filled from base_url and kept under
+    max_bytes, the same cache as the one of CC_Corpus(download_dir=download_dir, base_url=base_url, wet_cache=True,
+    wet_cache_size=max_bytes). It is set up again when called with another directory or base url"""
+    global wet_cache
+    root = os.path.join(download_dir, "wet_cache")
+    if wet_cache is None or wet_cache.root != root or wet_cache.downloader.base_url != base_url.rstrip("/"):
+        wet_cache = WetCache(root, Downloader(base_url), max_bytes=max_bytes)
+    wet_cache.max_bytes = max_bytes
+    return wet_cache
+
+
+def read_wet(file_dir: str, workers: Optional[int] = None, max_page_bytes: Optional[int] = None,
+             cache: Optional[WetCache] = None) -> pd.DataFrame:
+    """Lines of a WET file as one DataFrame: all batches of iter_wet_batches, exact duplicates removed.
+    file_dir is a local WET file, or the path of a segment in Common Crawl (crawl-data/CC-MAIN-.../...warc.wet.gz)
+    which is read through cache, e.g. the wet_cache of a CC_Corpus (get_wet_cache() by default). With workers, a
+    local file is split on its gzip member boundaries and the parts are decompressed and processed by that many
+    processes"""
     logger.debug('Inside read_wet, directory is set as %s', file_dir)
     logger.info('Reading wet file')
+    if workers is not None and workers > 1:
+        local_path = file_dir if os.path.exists(file_dir) else (cache or get_wet_cache()).fetch(file_dir)
+        # A few parts per worker, so that a slow part does not hold up the others
+        ranges = member_ranges(local_path, workers * 4)
+        with mp.Pool(processes=workers) as pool:
+            parts = pool.imap(_read_wet_range, [(local_path, start, end, max_page_bytes) for start, end in ranges])
+            batches = [batch for part in parts for batch in part]
+    else:
+        batches = list(iter_wet_batches(file_dir, max_page_bytes=max_page_bytes, cache=cache))
+
+    df = pd.concat(batches, ignore_index=True) if batches else _page_batch([])
+    deduplicate(df)
+    return df
+    # save_df(df, filename=filename.replace("/", ".") + ".processed")
+
+
+def iter_wet_batches(file_dir: str, batch_size: int = 256, max_page_bytes: Optional[int] = None, start: int = 0,
+                     end: Optional[int] = None, cache: Optional[WetCache] = None) -> Iterator[pd.DataFrame]:
+    """Lines of a WET file as they are read, one DataFrame (Domain, Country, URL, LineID, Text, Hash) per
+    batch_size pages; duplicates are left in. A local gzipped file is memory-mapped and its records inflated
+    straight from the map, between bytes start and end if given (see wet_reader.member_ranges). Other paths are
+    streamed through warcio, Common Crawl segments through cache (get_wet_cache() by default).
+    e.g.
+        for batch in iter_wet_batches("CC-MAIN-...warc.wet.gz"):
+            ...
+    """
+    pages = []
+    for page in _wet_pages(file_dir, max_page_bytes, start, end, cache):
+        pages.append(page)
+        if len(pages) == batch_size:
+            yield _page_batch(pages)
+            pages = []
+    if pages:
+        yield _page_batch(pages)
+
+
+def _is_gzip_file(file_dir: str) -> bool:
+    if not os.path.isfile(file_dir):
+        return False
     with open(file_dir, "rb") as file:
-        lines = []
-        for record in warcio.ArchiveIterator(file):
-            if temp := extract_wet_record(record):
-                lines.extend(temp)
-
-        df = pd.DataFrame(lines)
-        deduplicate(df)
-        return df
-        # save_df(df, filename=filename.replace("/", ".") + ".processed")
+        return file.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+
+
+def _wet_pages(file_dir: str, max_page_bytes: Optional[int] = None, start: int = 0, end: Optional[int] = None,
+               cache: Optional[WetCache] = None) -> Iterator[Tuple[str, str, str]]:
+    """(url, url_suffix, web_content) of the pages of a WET file from the countries we keep, only the payload of
+    these pages is decoded"""
+    if _is_gzip_file(file_dir):
+        with open(file_dir, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer, \
+                closing(iter_records(buffer, start, end)) as records:
+            for headers, payload in records:
+                if headers.get("WARC-Type") != "conversion":
+                    continue
+                url = headers.get("WARC-Target-URI")
+                if url_suffix := _match_url(url):
+                    yield url, url_suffix, utilities.decode_wet_content(payload, max_page_bytes)
+    else:
+        with (open(file_dir, "rb") if os.path.exists(file_dir) else (cache or get_wet_cache()).open(file_dir)) as file:
+            for record in warcio.ArchiveIterator(file):
+                if record.rec_type != "conversion":
+                    continue
+                url = record.rec_headers.get_header("WARC-Target-URI")
+                if url_suffix := _match_url(url):
+                    yield url, url_suffix, utilities.read_wet_content(record, max_page_bytes)
+
+
+def _page_batch(pages: List[Tuple[str, str, str]]) -> pd.DataFrame:
+    """Clean the lines of a batch of pages at once and lay them out as columns"""
+    lines = []
+    page_sizes = []
+    for _, _, web_content in pages:
+        page_lines = web_content.splitlines()
+        lines.extend(page_lines)
+        page_sizes.append(len(page_lines))
+    positions, cleaned = line_cleaner.clean_batch(lines)
+
+    # Page of each accepted line, and its number within the page
+    page_index = np.repeat(np.arange(len(pages)), page_sizes)[positions]
+    line_nums = np.arange(len(page_index)) - np.searchsorted(page_index, page_index) + 1
+    urls = np.array([url for url, _, _ in pages], dtype=object)
+    suffixes = np.array([url_suffix for _, url_suffix, _ in pages], dtype=object)
+    countries = np.array([utilities.COUNTRY_CODES_NAME[url_suffix] for _, url_suffix, _ in pages], dtype=object)
+    return pd.DataFrame({"Domain": suffixes[page_index], "Country": countries[page_index], "URL": urls[page_index],
+                         "LineID": line_nums, "Text": cleaned, "Hash": hash_lines(cleaned)})
+
+
+def _read_wet_range(file_range: Tuple[str, int, int, Optional[int]]) -> List[pd.DataFrame]:
+    """Batches of the records between two member boundaries of a WET file, see wet_reader.member_ranges"""
+    path, start, end, max_page_bytes = file_range
+    return list(iter_wet_batches(path, max_page_bytes=max_page_bytes, start=start, end=end))
+
+
+def _match_url(url: str) -> Optional[str]:
+    """Suffix of the url if it is a country code we keep and the site is not a multinational one"""
+    # country code first, the domain is only resolved for the urls of the countries we keep
+    url_suffix = utilities.url_country(url)
+    # TODO There are bugs where the tldextract url of trademe.co.nz would have the suffix of 'co.nz'
+    if url_suffix not in utilities.COUNTRY_CODES_NAME.keys() or mnc_filter.is_filtered(url):
+        return
+    return url_suffix
 
 
-def extract_wet_record(wrac_record) -> Optional[List[Tuple[str, str, str, int, str, int]]]:
+def extract_wet_record(wrac_record, max_page_bytes: Optional[int] = None
+                       ) -> Optional[List[Tuple[str, str, str, int, str, int]]]:
     """Process individual WRAC record in WET file, return list ofi
-    url_suffix, current_country, current_region, url, line"""
+    url_suffix, current_country, current_region, url, line
+    At most max_page_bytes of the page are decoded if given"""
     if wrac_record.rec_type != "conversion":
         return
     url: str = wrac_record.rec_headers.get_header("WARC-Target-URI")
     logger.debug('inside extract_wet_record: url of record is %s', str(url))
-    # getting domain abc.example.com -> ExtractResult(subdomain='abc', domain='hostname', suffix='com')
-    url_domain, url_suffix = utilities.extract_url(url)
-
-    # TODO There are bugs where the tldextract url of trademe.co.nz would have the suffix of 'co.nz'
-    if url_suffix not in utilities.COUNTRY_CODES_NAME.keys() or url_domain in utilities.URL_FILTER:
+    if (url_suffix := _match_url(url)) is None:
         return
     current_country = utilities.COUNTRY_CODES_NAME.get(url_suffix)
 
-    web_content: str = wrac_record.content_stream().read().decode("utf-8")
-    # we need the line larger than 15 character
+    web_content: str = utilities.read_wet_content(wrac_record, max_page_bytes)
     processed_line: List[Tuple[str, str, str, int, str, int]] = []
     line_num = 0  # flag to make sure it is the same page
-    for line in web_content.splitlines():
-        if len(line) <= 15:
-            continue
-        # Remove links, hashtags, at-mentions, mark-up, and "RT"
-        line = re.sub(r"http\S+", "", line)
-        line = re.sub(r"@\S+", "", line)
-        line = re.sub(r"#\S+", "", line)
-        line = re.sub("<[^>]*>", "", line)
-
-        # Remove emojis
-        line = utilities.remove_emoji(line)
-
-        # Remove extra spaces
-        line = pipe(line,
-                    preprocessing.strip_tags, preprocessing.split_alphanum, preprocessing.strip_multiple_whitespaces)
-        # Check if still above 15 and not contains any navigational / boilerplate characters
-        if len(line) <= 15 or any(char in line for char in utilities.ILLEGAL_CHAR):
-            continue
-        # Check if mostly numbers / characters
-        character_only: str = pipe(line, preprocessing.strip_numeric, preprocessing.strip_punctuation)
-        if len(character_only) <= 12:
-            continue
-        # Check if line has Chinese / Japanese / Korean characters, then set length to 15:
-        if any(juxt(alphabet_detector.is_cjk,
-                    alphabet_detector.is_hangul,
-                    alphabet_detector.is_hiragana,
-                    alphabet_detector.is_katakana
-                    )(line)):
-            length = 15
-        else:
-            length = 50
-        if len(line) < length:
-            continue
-        text_hash = hash(line)
-        string_counter = collections.Counter(line)
-        if all([string_counter.get("-", 0) < 4, string_counter.get("(", 0) < 4, string_counter.get(")", 0) < 4,
-                string_counter.get("=", 0) < 2, string_counter.get("_", 0) < 2, string_counter.get(".", 0) < 15,
-                string_counter.get("&", 0) < 4, string_counter.get("[", 0) < 3, string_counter.get("]", 0) < 3,
-                string_counter.get("*", 0) < 5]):
-            line_num += 1
-            processed_line.append((url_suffix, current_country, url, line_num, line, text_hash))
+    for line in line_cleaner.clean_lines(web_content):
+        text_hash = line_hash(line)
+        line_num += 1
+        processed_line.append((url_suffix, current_country, url, line_num, line, text_hash))
     return processed_line
 
 
 def deduplicate(df: pd.DataFrame):
-    # TODO This deduplication only consider exact duplicate, which is not usually applicable in practice,
-    #  maybe looking in to Levenshtein distance: TheFuzz, jellyfish or difflib.SequenceMatcher
+    # This deduplication only consider exact duplicate, see Deduplicator.deduplicate_cluster for near-duplicates
     df.columns = ("Domain", "Country", "URL", "LineID", "Text", "Hash")
     original_len = len(df.index)
     df.drop_duplicates(subset="Hash", inplace=True, ignore_index=True)
@@ -111,22 +188,12 @@ def deduplicate(df: pd.DataFrame):
     logger.debug(f"Formatted and Removed {original_len - len(df.index)} with remaining: {len(df.index)}")
 
 
-def drop_mnc_url(df: pd.DataFrame):
+def drop_mnc_url(df: pd.DataFrame, url_filter: Optional[UrlFilter] = None):
     # This function drops the URL based on the list of known international companies provided earlier. Specify
-    # your own or build better tools.
+    # your own with url_filter, e.g. UrlFilter(files=[...])
     logger.info('inside drop_mnc_url: dropping urls of mncs')
-    df.columns = ("Domain", "Country", "URL", "LineID", "Text")
+    url_filter = url_filter or mnc_filter
     original_len = len(df.index)
-    # for each url, where domain is a member of set of URLs
-    print(f"Removed {original_len - len(df.index)} with remaining: {len(df.index)}")
-    raise NotImplementedError
-
-
-class Deduplicator:
-    """This class exists over the lifecycle of a processing run in order to 
-    hold statistics, hashstate for record elimintion between shards and prevent 
-    costly rereading of url lists into the system. It has three main methods, 
-    deduplicate_exact, deduplicate_cluster, deduplicate_international 
-    deduplicate exact removes the exact matching records,
-    deduplicate clusters removes the clusters LSA matching records,
-    dedupliate international removes multinational websites from the records"""
+    df.drop(df.index[url_filter.mask(df["URL"])], inplace=True)
+    df.reset_index(drop=True, inplace=True)
+    logger.debug(f"Removed {original_len - len(df.index)} with remaining: {len(df.index)}")
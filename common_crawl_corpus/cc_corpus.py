@@ -1,21 +1,36 @@
-import collections
-import glob
 import gzip
 import logging
 import multiprocessing as mp
 import os
+import threading
+import time
+from collections import deque
 from functools import partial
 from multiprocessing.pool import ThreadPool
-from typing import List, Optional, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 
+import numpy as np
 import pandas as pd
-import requests
-from alphabet_detector import AlphabetDetector
-from cytoolz import pipe, juxt
-from gensim.parsing import preprocessing
+import pyarrow as pa
+import pyarrow.compute as pc
+from tqdm import tqdm
 from warcio.archiveiterator import ArchiveIterator
 
 from . import utilities
+from .cleaning import LineCleaner
+from .domain_stats import DomainStats, find_files
+from .corpus_store import (CORPUS_EXTENSIONS, corpus_files, list_partitions, partition_dir, table_stats, word_counts,
+                           write_parquet)
+from .deduplicator import Deduplicator
+from .downloader import CC_BASE_URL, Downloader
+from .hashing import line_hash
+from .ledger import SegmentLedger
+from .lid_pool import LidPool
+from .manifest import CorpusManifest
+from .segment_writer import SegmentWriter, read_segment, write_segment
+from .shard_writer import merge_partition
+from .url_filter import UrlFilter
+from .wet_cache import WetCache
 
 # This dictionary maps country codes to (English) country names
 COUNTRY_CODE_NAME = {
@@ -137,15 +152,81 @@ COUNTRY_CODE_REGION = {
 
 # ---------------------
 
-def process_lid(segment, input_dir, output_dir):
+# Language identification model used by process_lid
+LID_MODEL = os.path.join("lid", "lidNet", "Models", "Model.LID.MLP.400kx3_hash.1-3grams.262k.hdf")
+# Model of a lid_cc worker process, set by _init_lid_worker
+_lid_model_path = LID_MODEL
+# lidNet model of a process, loaded on first use and shared by all its segments
+_lid_model = None
+# CLD2/CLD3 check of a lid_cc worker process, in the process itself as pool workers cannot start their own
+_lid_pool: Optional[LidPool] = None
+
+
+def _init_lid_worker(model_path: str = LID_MODEL):
+    # Nothing is loaded here: a pool restarts forever a worker whose initializer raises, errors of the first
+    # segment go back to lid_cc instead
+    global _lid_model_path
+    _lid_model_path = model_path
+
+
+def predict_languages(texts: List[str], batch_size: int = 4096) -> List[str]:
+    """Language of each text, batch_size texts per call to the model's predict. The model is loaded on first use,
+    from the model_path of lid_cc in its workers"""
+    global _lid_model
+    if _lid_model is None:
+        from lid.lidNet.lidNet import lidNet
+        _lid_model = lidNet(_lid_model_path)
+    languages = []
+    for start in range(0, len(texts), batch_size):
+        languages.extend(_lid_model.predict(texts[start:start + batch_size]))
+    return languages
+
+
+def assemble_pages(df: pd.DataFrame) -> pd.DataFrame:
+    """Join the lines of each page: one row per URL with its number of words and its lines joined with newlines, in
+    their order in df. Pages come sorted by URL, as from a groupby. The lines are sorted once and joined by pyarrow
+    over the runs of each URL, word counts are added up per run"""
+    table = pa.Table.from_pandas(df[["URL", "Text"]], preserve_index=False)
+    urls = pc.cast(table["URL"], pa.string()).combine_chunks()
+    texts = pc.cast(table["Text"], pa.large_string()).combine_chunks()
+    order = pc.sort_indices(urls)
+    urls = urls.take(order)
+    texts = texts.take(order)
+    if not len(urls):
+        return pd.DataFrame({"URL": pd.Series(dtype=str), "N_Words": pd.Series(dtype=int),
+                             "Text": pd.Series(dtype=str)})
+
+    # First line of each page
+    starts = np.flatnonzero(np.concatenate(
+        [[True], pc.not_equal(urls[1:], urls[:-1]).to_numpy(zero_copy_only=False)]))
+    pages = pc.binary_join(pa.ListArray.from_arrays(np.append(starts, len(urls)).astype(np.int32), texts),
+                            pa.scalar("\n", pa.large_string()))
+
+    return pd.DataFrame({"URL": urls.take(starts).to_pandas(), "N_Words": np.add.reduceat(word_counts(texts), starts),
+                         "Text": pages.to_pandas()})
+
+
+def split_by_language(df: pd.DataFrame):
+    """(language, rows) for each language of df, rows in their order in df, from a single sort"""
+    df = df.sort_values("Language", kind="stable")
+    languages, starts = np.unique(df["Language"].to_numpy(dtype=str), return_index=True)
+    for language, start, end in zip(languages, starts, np.append(starts[1:], len(df))):
+        yield str(language), df.iloc[start:end]
+
+
+def process_lid(segment, input_dir, output_dir, batch_size: int = 4096, corpus_format: str = "csv",
+                lid_pool: Optional[LidPool] = None
+                ) -> List[Tuple[str, str, str, str, Dict[str, Union[int, str, None]]]]:
+    """Assemble the pages of a segment, identify their language and write one file per language. With a lid_pool,
+    only the pages that CLD2 and CLD3 also identify as that language are kept. Returns (path, region, country,
+    language, counts) of the files written, for the corpus manifest"""
     # Check if file has been processed
     check = segment.replace("/", ".").replace(".hdf", ".txt")
+    written = []
 
     if check not in list(os.listdir(os.path.join(".", "check"))):
 
         print("Starting " + segment)
-        from lid.lidNet.lidNet import lidNet
-        lid = lidNet(os.path.join("lid", "lidNet", "Models", "Model.LID.MLP.400kx3_hash.1-3grams.262k.hdf"))
 
         # Load and prepare
         current_df = pd.read_hdf(segment, key="data")
@@ -161,27 +242,25 @@ def process_lid(segment, input_dir, output_dir):
         current_time_write = current_time
         current_time = current_time[:7]
 
-        text_list = []  # Initialize
-
-        # Join texts by webpage
-        for section in current_df.groupby(by="URL"):
-            current_url = str(section[0])
-            text = section[1].Text.values
-            text = "\n".join(text)
-            current_size = len(text.split())
-
-            text_list += [(current_time, current_url, current_size, text)]
+        current_df = assemble_pages(current_df)
+        current_df.insert(0, "Time", current_time)
+        current_df.loc[:, "Language"] = predict_languages(list(current_df.loc[:, "Text"].values), batch_size)
+        if lid_pool is not None:
+            current_df = current_df[lid_pool.agree(current_df.loc[:, "Text"].tolist(),
+                                                   current_df.loc[:, "Language"].tolist())]
 
-        current_df = pd.DataFrame(text_list, columns=["Time", "URL", "N_Words", "Text"])
-        current_df.loc[:, "Language"] = lid.predict(list(current_df.loc[:, "Text"].values))
-
-        for section in current_df.groupby(by="Language"):
-            current_lang = str(section[0])
+        for current_lang, section in split_by_language(current_df):
             write_name = current_region + "." + current_country + "." + current_lang + "." + current_time_write
-            os.makedirs(os.path.join(output_dir, current_region, current_country, current_lang), exist_ok=True)
-            write_name = os.path.join(output_dir, current_region, current_country, current_lang, write_name)
-            section = section[1]
-            section.to_csv(write_name + ".gz", header=True, index=False, index_label=False, compression="gzip")
+            write_dir = partition_dir(output_dir, current_region, current_country, current_lang, corpus_format)
+            os.makedirs(write_dir, exist_ok=True)
+            write_name = os.path.join(write_dir, write_name)
+            if corpus_format == "parquet":
+                write_name += ".parquet"
+                write_parquet(section, write_name)
+            else:
+                write_name += ".gz"
+                section.to_csv(write_name, header=True, index=False, index_label=False, compression="gzip")
+            written.append((write_name, current_region, current_country, current_lang, table_stats(section)))
 
         # Done with all langs
         with open(os.path.join("check", check), "w") as fo:
@@ -190,7 +269,85 @@ def process_lid(segment, input_dir, output_dir):
         os.remove(segment)
         print("\tDeleted " + segment)
 
-        return
+    return written
+
+
+def _process_lid_task(segment, verify: bool = False, **kwargs):
+    """process_lid inside a lid_cc worker process, with the worker's CLD2/CLD3 check if verify"""
+    global _lid_pool
+    if verify and _lid_pool is None:
+        _lid_pool = LidPool(workers=0)
+    return process_lid(segment, lid_pool=_lid_pool, **kwargs)
+
+
+def finalize_partition(input_dir, output_dir, region, country, language, shard_size: int = 100000,
+                       block_size: int = 2 ** 24,
+                       corpus_format: str = "csv") -> Tuple[int, List[str], List[Dict[str, Union[int, str, None]]]]:
+    """Merge the files of one region/country/language into shards and delete them, see
+    shard_writer.merge_partition. Returns the number of pages read, the shards written and their counts"""
+    files = corpus_files(partition_dir(input_dir, region, country, language, corpus_format), corpus_format)
+    pages, shards, stats = merge_partition(files, partition_dir(output_dir, region, country, language, corpus_format),
+                                    region + "." + country + "." + language, shard_size, block_size, corpus_format)
+
+    # Done, now delete
+    for file in files:
+        os.remove(file)
+    return pages, shards, stats
+
+
+def _finalize_task(task: Tuple[str, str, str, str, str, int, int, str]) -> Tuple[str, str, int, List[str],
+                                                                                List[Dict], float]:
+    """finalize_partition inside a final_cc worker process, with its duration"""
+    start = time.time()
+    pages, shards, stats = finalize_partition(*task)
+    return task[3], task[4], pages, shards, stats, time.time() - start
+
+
+def _physical_memory() -> Optional[int]:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+# --------------------
+
+def process_wet_pages(pages: List[Tuple[str, str, str]],
+                      line_cleaner: LineCleaner) -> List[Tuple[str, str, str, int, str, int]]:
+    """Split a batch of (url, url_suffix, web_content) pages into lines and keep the ones passing the filters of
+    line_cleaner, which run once over all lines of the batch"""
+    lines = []
+    page_sizes = []
+    for _, _, web_content in pages:
+        page_lines = web_content.splitlines()
+        lines.extend(page_lines)
+        page_sizes.append(len(page_lines))
+    positions, cleaned = line_cleaner.clean_batch(lines)
+
+    # Page of each accepted line, and its number within the page
+    page_index = np.repeat(np.arange(len(pages)), page_sizes)[positions]
+    line_nums = np.arange(len(page_index)) - np.searchsorted(page_index, page_index) + 1
+
+    processed_line: List[Tuple[str, str, str, int, str, int]] = []
+    for page, line_num, line in zip(page_index.tolist(), line_nums.tolist(), cleaned):
+        url, url_suffix, _ = pages[page]
+        processed_line.append((url_suffix, COUNTRY_CODE_NAME.get(url_suffix), url, line_num, line, line_hash(line)))
+    return processed_line
+
+
+# LineCleaner of a pipeline worker process, the parent's one, set up once by _init_wet_worker. Pages reach the
+# worker already matched and truncated to max_page_bytes, line cleaning is all that is left to do there
+_wet_line_cleaner: Optional[LineCleaner] = None
+
+
+def _init_wet_worker(line_cleaner: LineCleaner):
+    global _wet_line_cleaner
+    _wet_line_cleaner = line_cleaner
+
+
+def _process_wet_batch(batch: List[Tuple[str, str, str]]) -> List[Tuple[str, str, str, int, str, int]]:
+    """Process a batch of (url, url_suffix, web_content) pages inside a pipeline worker process"""
+    return process_wet_pages(batch, _wet_line_cleaner)
 
 
 # --------------------
@@ -200,23 +357,55 @@ class CC_Corpus(object):
     def __init__(self,
                  countries_to_skip=None,
                  url_filter: Optional[Union[str, os.PathLike, bytes]] = None,
-                 download_dir: Union[str, os.PathLike, bytes] = "./common_crawl_download"):
+                 download_dir: Union[str, os.PathLike, bytes] = "./common_crawl_download",
+                 max_content_length: Optional[int] = None,
+                 max_page_bytes: Optional[int] = None,
+                 rows_per_batch: int = 2 ** 16,
+                 dedup_index_dir: Optional[Union[str, os.PathLike]] = None,
+                 near_dedup: bool = False,
+                 base_url: str = CC_BASE_URL,
+                 wet_cache: bool = False,
+                 wet_cache_size: Optional[int] = None):
 
         # Ignore certain countries if there is already enough data
         if countries_to_skip is None:
             countries_to_skip = []
         self.countries_to_skip = countries_to_skip
 
-        # Url filter list from file
-        self.url_filter = []
-        if url_filter is not None:
-            self.url_filter = utilities.get_url_filters_from_file(url_filter).keys()
+        # Url filter list from file, re-read between chunks when the file changes
+        self.url_filter = UrlFilter(domains=(), files=[] if url_filter is None else [url_filter])
 
         # Download directory
         self.download_dir = download_dir
 
-        # Detecting language based on alphabet
-        self.alphabet_detector = AlphabetDetector()
+        # Pooled, retrying and resuming downloads from base_url (Common Crawl, or a mirror)
+        self.downloader = Downloader(base_url)
+
+        # Local copy of the segments read, download_dir/wet_cache, kept under wet_cache_size bytes if given: processing
+        # a crawl again reads the segments from disk
+        self.wet_cache = None
+        if wet_cache:
+            self.wet_cache = WetCache(os.path.join(download_dir, "wet_cache"), self.downloader,
+                                      max_bytes=wet_cache_size)
+
+        # Record skipping: pages declaring a larger Content-Length are skipped without reading their payload, and
+        # at most max_page_bytes of a page are decoded
+        self.max_content_length = max_content_length
+        self.max_page_bytes = max_page_bytes
+
+        # Processed segments are written rows_per_batch lines at a time
+        self.rows_per_batch = rows_per_batch
+
+        # Line cleaning and filtering, compiled once
+        self.line_cleaner = LineCleaner()
+
+        # Crawl-wide exact deduplication: with an index directory, lines already kept in an earlier chunk or crawl
+        # processed against the same directory are dropped too, not only the duplicates within a chunk
+        self.deduplicator = None if dedup_index_dir is None else Deduplicator(dedup_index_dir)
+        # and with near_dedup, lines close to one kept before (MinHash / LSH) are dropped as well
+        if near_dedup and self.deduplicator is None:
+            raise ValueError("near_dedup needs a dedup_index_dir to keep the signatures of the lines seen")
+        self.near_dedup = near_dedup
 
         # This list defines what countries to include in the corpus
         self.country_codes = []
@@ -234,87 +423,140 @@ class CC_Corpus(object):
     # setup input and output dirs for methods
 
     # ----------------------------------------------------------------------------------------------#
-    def _process_wet_record(self, wet_record) -> Optional[List[Tuple[str, str, str, int, str, int]]]:
-        """Read individual wet record, split the content to different paragraph, apply filter to remove unwanted
-        character and short/trivial lines """
+    def _match_wet_record(self, wet_record) -> Optional[Tuple[str, str]]:
+        """Check the headers of a wet record, return (url, url_suffix) if the page belongs to a country we keep.
+        Only headers are looked at, the payload of a rejected record is never read or decoded"""
         if wet_record.rec_type != "conversion":
             return
+        if self.max_content_length is not None:
+            content_length = utilities.wet_content_length(wet_record)
+            # a page without any line longer than 15 characters has nothing to keep
+            if content_length is not None and not 15 < content_length <= self.max_content_length:
+                return
         url = wet_record.rec_headers.get_header("WARC-Target-URI")
-        # getting domain abc.example.com -> ExtractResult(subdomain='abc', domain='hostname', suffix='com')
-        url_domain, url_suffix = utilities.extract_url(url)
+        # country code first, the domain is only resolved for the urls of the countries we keep
+        url_suffix = utilities.url_country(url)
 
-        if url_suffix not in COUNTRY_CODE_NAME.keys() or url_domain in self.url_filter:
+        if url_suffix not in COUNTRY_CODE_NAME.keys() or self.url_filter.is_filtered(url):
             return
-        current_country = COUNTRY_CODE_NAME.get(url_suffix)
+        return url, url_suffix
 
-        web_content: str = wet_record.content_stream().read().decode("utf-8")
+    def _process_wet_record(self, wet_record) -> Optional[List[Tuple[str, str, str, int, str, int]]]:
+        """Read individual wet record, split the content to different paragraph, apply filter to remove unwanted
+        character and short/trivial lines """
+        if (match := self._match_wet_record(wet_record)) is None:
+            return
+        url, url_suffix = match
+        web_content: str = utilities.read_wet_content(wet_record, self.max_page_bytes)
+        return self._process_wet_content(url, url_suffix, web_content)
+
+    def _process_wet_content(self, url: str, url_suffix: str,
+                             web_content: str) -> List[Tuple[str, str, str, int, str, int]]:
+        """Split the content of one page into lines and keep the ones passing the filters"""
+        current_country = COUNTRY_CODE_NAME.get(url_suffix)
         processed_line: List[Tuple[str, str, str, int, str, int]] = []
         line_num = 0  # flag to make sure it is the same page
 
-        for line in web_content.splitlines():
-            # we need the line larger than 15 character
-            if len(line) <= 15:
-                continue
-            line = pipe(line,
-                        # Remove links, hashtags, at-mentions, mark-up, and "RT"
-                        utilities.strip_tags,
-                        # Remove emojis
-                        utilities.remove_emoji,
-                        # Remove extra spaces
-                        preprocessing.strip_tags,
-                        preprocessing.split_alphanum,
-                        preprocessing.strip_multiple_whitespaces)
-
-            # Check if still above 15 and not contains any navigational / boilerplate characters
-            if len(line) <= 15 or any(char in line for char in utilities.ILLEGAL_CHAR):
-                continue
-            # Check if mostly numbers / characters
-            character_only = pipe(line, preprocessing.strip_numeric, preprocessing.strip_punctuation)
-            if len(character_only) <= 12:
-                continue
-            # Check if line has Chinese / Japanese / Korean characters, then set length to 15:
-            if any(juxt(self.alphabet_detector.is_cjk,
-                        self.alphabet_detector.is_hangul,
-                        self.alphabet_detector.is_hiragana,
-                        self.alphabet_detector.is_katakana
-                        )(line)):
-                length = 15
-            else:
-                length = 50
-            if len(line) < length:
-                continue
-            text_hash = hash(line)
-            string_counter = collections.Counter(line)
-            if all([string_counter.get("-", 0) < 4, string_counter.get("(", 0) < 4, string_counter.get(")", 0) < 4,
-                    string_counter.get("=", 0) < 2, string_counter.get("_", 0) < 2, string_counter.get(".", 0) < 15,
-                    string_counter.get("&", 0) < 4, string_counter.get("[", 0) < 3, string_counter.get("]", 0) < 3,
-                    string_counter.get("*", 0) < 5]):
-                line_num += 1
-                processed_line.append((url_suffix, current_country, url, line_num, line, text_hash))
+        for line in self.line_cleaner.clean_lines(web_content):
+            text_hash = line_hash(line)
+            line_num += 1
+            processed_line.append((url_suffix, current_country, url, line_num, line, text_hash))
         return processed_line
 
-    def download_and_process_wet_segment(self, index: str):
+    def _process_wet_pages(self, pages: List[Tuple[str, str, str]]) -> List[Tuple[str, str, str, int, str, int]]:
+        """Same as _process_wet_content over a batch of (url, url_suffix, web_content) pages, see process_wet_pages"""
+        return process_wet_pages(pages, self.line_cleaner)
+
+    def download_and_process_wet_segment(self, index: str, ledger: Optional[SegmentLedger] = None,
+                                         batch_size: int = 64):
         """
         Downloads (as stream) the second level index file for the given year range. Doesn't need to save the actual files
-        Then, processes returns a dataframe containing the common fields
+        Then, processes and writes the common fields to a feather file as it goes
         e.g. crawl-data/CC-MAIN-2022-40/segments/1664030331677.90/wet/CC-MAIN-20220924151538-20220924181538-00000.warc.wet.gz
+        Pages are cleaned batch_size at a time. If a ledger is given, the segment is marked as downloaded once the
+        whole stream has been read
         """
         self.logger.debug(f"download & process_wet_segment: processing {os.path.basename(index)}")
-        url = f"https://data.commoncrawl.org/{index}".strip()
-        segment_stream = requests.get(url, stream=True)
-
-        lines = []
-        for record in ArchiveIterator(segment_stream.raw):
-            if temp := self._process_wet_record(record):
-                lines.extend(temp)
+        with self._open_segment(index) as segment_stream, \
+                SegmentWriter(self._segment_path(index), rows_per_batch=self.rows_per_batch) as writer:
+            batch = []
+            for record in ArchiveIterator(segment_stream):
+                if (match := self._match_wet_record(record)) is None:
+                    continue
+                url, url_suffix = match
+                batch.append((url, url_suffix, utilities.read_wet_content(record, self.max_page_bytes)))
+                if len(batch) >= batch_size:
+                    writer.write(self._process_wet_pages(batch))
+                    batch = []
+            if batch:
+                writer.write(self._process_wet_pages(batch))
+            if ledger is not None:
+                ledger.mark([index], SegmentLedger.DOWNLOADED)
+
+    def _stream_wet_segment(self, index: str, process_pool, slots: threading.BoundedSemaphore, batch_size: int,
+                            ledger: Optional[SegmentLedger] = None):
+        """
+        Download thread of the pipelined mode: streams one segment, sends batches of matching pages to the process
+        pool and writes their results in order as they come back. Blocks on `slots` while the process pool is
+        saturated, which stops reading from the network until processing catches up.
+        """
+        self.logger.debug(f"_stream_wet_segment: processing {os.path.basename(index)}")
+        pending = deque()
+
+        with self._open_segment(index) as segment_stream, \
+                SegmentWriter(self._segment_path(index), rows_per_batch=self.rows_per_batch) as writer:
+            def submit(batch):
+                slots.acquire()
+                pending.append(process_pool.apply_async(_process_wet_batch, (batch,),
+                                                        callback=lambda _: slots.release(),
+                                                        error_callback=lambda _: slots.release()))
+                # write what is already done, keeping the order of the segment
+                while pending and pending[0].ready():
+                    writer.write(pending.popleft().get())
+
+            batch = []
+            for record in ArchiveIterator(segment_stream):
+                if (match := self._match_wet_record(record)) is None:
+                    continue
+                url, url_suffix = match
+                batch.append((url, url_suffix, utilities.read_wet_content(record, self.max_page_bytes)))
+                if len(batch) >= batch_size:
+                    submit(batch)
+                    batch = []
+            if batch:
+                submit(batch)
+            if ledger is not None:
+                ledger.mark([index], SegmentLedger.DOWNLOADED)
+
+            while pending:
+                writer.write(pending.popleft().get())
+
+    def _open_segment(self, index: str):
+        """Stream of a WET segment, through the local cache if there is one"""
+        if self.wet_cache is None:
+            return self.downloader.open(index)
+        return self.wet_cache.open(index)
+
+    def _segment_path(self, index: str) -> str:
+        """Path of the processed segment, download_dir/CC-MAIN-YYYY-WW/<segment name>.feather"""
         # add prefix dataframe to filename, change extension to .feather stead of gzip
         path_split = index.split(os.sep)
         cc_index = path_split[1]  # CC-MAIN-2022-40
         name, _ = os.path.splitext(path_split[-1])  # e.g. CC-MAIN-2....wet
+        return os.path.join(self.download_dir, cc_index, f'{name}.feather')
 
-        df = pd.DataFrame(lines, columns=("Domain", "Country", "URL", "LineID", "Text", "Hash"))
-        df.reset_index()
-        df.to_feather(os.path.join(self.download_dir, cc_index, f'{name}.feather'))
+    def _process_segment(self, index: str, ledger: SegmentLedger, stream_segment=None, batch_size: int = 64):
+        """Process one segment and record the outcome in the ledger, a failed segment is retried on the next run"""
+        try:
+            if stream_segment is None:
+                self.download_and_process_wet_segment(index, ledger=ledger, batch_size=batch_size)
+            else:
+                stream_segment(index, ledger=ledger)
+        except Exception as e:
+            self.logger.error(f"_process_segment: {os.path.basename(index)} failed with {e!r}")
+            ledger.mark([index], SegmentLedger.FAILED, error=repr(e))
+        else:
+            ledger.mark([index], SegmentLedger.PROCESSED)
 
     # ------------------------------------------------------------------------------------------------#
 
@@ -322,15 +564,12 @@ class CC_Corpus(object):
         """This method downloads the complete CC for a given prefix, from the path file to the WARC files.
         e.g. CC-MAIN-2022-40
         """
-        url = f"https://data.commoncrawl.org/crawl-data/{prefix_list}/wet.paths.gz"
         os.makedirs(os.path.join(self.download_dir, prefix_list), exist_ok=True)
         filepath = os.path.join(self.download_dir, prefix_list, f"{prefix_list}-wet.paths.gz".strip())
 
         self.logger.info(f'Download_cc: Prefix {prefix_list} downloading, \tsave dir: {filepath}')
 
-        response = requests.get(url)
-        with open(filepath, "wb") as file:
-            file.write(response.content)
+        self.downloader.download(f"crawl-data/{prefix_list}/wet.paths.gz", filepath)
         return filepath
 
     # ----------------------------------------------------------------------------------------------------------------------#
@@ -338,132 +577,246 @@ class CC_Corpus(object):
     def _deduplicate_cc(self, path_to_input: str, path_to_output=None):
         """This method conducts deduplication on a directory of crawl files"""
         self.logger.info(f'_deduplicate_cc: De-duplicating {os.path.basename(path_to_input)}')
-        df = pd.read_feather(path_to_input)
+        table = read_segment(path_to_input)
         if path_to_output is None:
             path_to_output = path_to_input
-        original_len = len(df.index)
-        df.drop_duplicates(subset="Hash", inplace=True, ignore_index=True)
+        original_len = table.num_rows
+        # Only the hash column goes through pandas, the text and the dictionary encoded columns stay in arrow
+        hashes = table.column("Hash").to_numpy()
+        if self.deduplicator is None:
+            keep = ~pd.Series(hashes).duplicated(keep="first").to_numpy()
+        else:
+            keep = self.deduplicator.deduplicate_exact(hashes, name=os.path.basename(path_to_output))
+            if self.near_dedup:
+                kept = np.flatnonzero(keep)
+                keep[kept] = self.deduplicator.deduplicate_cluster(table.column("Text").take(kept).to_pylist(),
+                                                                   name=os.path.basename(path_to_output))
+        table = table.filter(keep)
         self.logger.debug(
-            f"_deduplicate_cc: {original_len} formatted and removed {original_len - len(df.index)}, remaining: {len(df.index)}")
-        df.to_feather(path_to_output)
+            f"_deduplicate_cc: {original_len} formatted and removed {original_len - table.num_rows}, "
+            f"remaining: {table.num_rows}")
+        write_segment(table, path_to_output)
         self.logger.debug(f'_deduplicate_cc: saved as {path_to_output}')
 
         # ------------------------------------------------------------------------------------------------------------#
 
-    def automatically_process_crawl(self, prefix_list, chunk_size=2):
+    def automatically_process_crawl(self, prefix_list, chunk_size=2,
+                                    download_workers: Optional[int] = None,
+                                    process_workers: Optional[int] = None,
+                                    queue_depth: Optional[int] = None,
+                                    batch_size: int = 64):
         """Automatically download, process, and deduplicate on 1 prefix
         e.g. CC-MAIN-2022-40
+
+        By default segments are downloaded and processed one after another, batch_size pages at a time. Setting
+        download_workers turns on the pipelined mode: that many threads stream segments while a pool of
+        process_workers processes (cpu count by default) cleans the batches of pages. At most queue_depth batches
+        (2 per process worker by default) are in flight, downloads wait when processing falls behind.
+
+        Progress is kept in a SegmentLedger at download_dir/<prefix>/ledger.sqlite, running again on the same prefix
+        skips the chunks already deduplicated and only processes the segments that are not done yet. With the
+        dedup_index_dir of the class, lines are also deduplicated against all chunks processed before.
         """
         self.logger.debug(f'automatically_process_crawl: begin processing on {prefix_list}')
         prefix_filedir = self.download_cc(prefix_list)
         with gzip.open(prefix_filedir) as index_file:
             lines = [line.decode("utf-8").rstrip() for line in index_file.readlines()]
         chunks = utilities.divide_list(lines, chunk_size)
-        # process each chunk
-        for i, chunk in enumerate(chunks, start=1):
-            self.logger.info(f'Processing chunk {i} of {len(chunks)}')
-            self.logger.debug(chunk)
-            for segment in chunk:
-                self.download_and_process_wet_segment(segment)
+        ledger = SegmentLedger(os.path.join(self.download_dir, prefix_list, "ledger.sqlite"))
+        ledger.add_segments(lines)
+
+        if download_workers:
+            process_pool = mp.Pool(processes=process_workers, initializer=_init_wet_worker,
+                                   initargs=(self.line_cleaner,))
+            download_pool = ThreadPool(download_workers)
+            if queue_depth is None:
+                queue_depth = 2 * (process_workers or os.cpu_count())
+            stream_segment = partial(self._stream_wet_segment,
+                                     process_pool=process_pool,
+                                     slots=threading.BoundedSemaphore(queue_depth),
+                                     batch_size=batch_size)
+        try:
+            # process each chunk
+            for i, chunk in enumerate(chunks, start=1):
+                states = ledger.states(chunk)
+                if all(state == SegmentLedger.DEDUPLICATED for state in states.values()):
+                    self.logger.debug(f'Skipping chunk {i} of {len(chunks)}, already deduplicated')
+                    continue
+                self.logger.info(f'Processing chunk {i} of {len(chunks)}')
+                if self.url_filter.reload():
+                    self.logger.info(
+                        f'automatically_process_crawl: url filter reloaded, {len(self.url_filter)} entries')
+                self.logger.debug(chunk)
+                todo = [segment for segment in chunk if states[segment] in SegmentLedger.TODO]
+                if download_workers:
+                    download_pool.map(partial(self._process_segment, ledger=ledger, stream_segment=stream_segment),
+                                      todo, chunksize=1)
+                else:
+                    for segment in todo:
+                        self._process_segment(segment, ledger, batch_size=batch_size)
+                self._merge_chunk(prefix_list, chunk, ledger)
+            self.logger.info(f'automatically_process_crawl: {prefix_list} segments by state {ledger.summary()}')
+            self.logger.debug(f'automatically_process_crawl: url cache {utilities.url_cache.stats()}')
+            self.logger.info(f'automatically_process_crawl: downloads {self.downloader.stats}')
+            if self.wet_cache is not None:
+                self.logger.info(f'automatically_process_crawl: wet cache {self.wet_cache.stats()}')
+            if self.deduplicator is not None:
+                self.logger.info(f'automatically_process_crawl: crawl-wide deduplication removed '
+                                 f'{self.deduplicator.lines_removed} of {self.deduplicator.lines_checked} lines, '
+                                 f'{len(self.deduplicator.hash_index)} unique lines indexed, '
+                                 f'{self.deduplicator.near_duplicates_removed} near-duplicates removed')
+        finally:
+            ledger.close()
+            if download_workers:
+                download_pool.close()
+                download_pool.join()
+                process_pool.close()
+                process_pool.join()
+
+        # ----------------------------------------------------------------------------------------------------------------------#
+
+    def _merge_chunk(self, prefix_list: str, chunk: List[str], ledger: SegmentLedger):
+        """Combine the processed segments of a chunk and deduplicate them. Chunks with unfinished segments are left
+        for the next run, a chunk that was merged but not deduplicated picks up from the combined file."""
+        states = ledger.states(chunk)
+        if any(state in SegmentLedger.TODO for state in states.values()):
+            self.logger.warning(f'_merge_chunk: chunk of {os.path.basename(chunk[0])} has unfinished segments, '
+                                f'it will be merged on the next run')
+            return
 
+        # Save to file using the latest name, add prefix combined
+        df_files = [self._segment_path(segment) for segment in chunk]
+        filename = os.path.join(self.download_dir, prefix_list, f"combined-{os.path.basename(max(df_files))}")
+        if any(state == SegmentLedger.PROCESSED for state in states.values()):
             # Combine all dataframe within a shard
-            df_files = glob.glob(os.path.join(self.download_dir, prefix_list, 'CC-MAIN-*.feather'))
-            df_list = []
-            for df_file in df_files:
-                df_list.append(pd.read_feather(df_file))
+            table = pa.concat_tables([read_segment(df_file) for df_file in df_files])
+            # Segments processed before the url filter was last reloaded
+            if len(self.url_filter):
+                table = table.filter(~self.url_filter.mask(table.column("URL")))
+            write_segment(table, filename)
+            ledger.mark(chunk, SegmentLedger.MERGED)
+
+        # Dedupe, add prefix deduplicated
+        new_filename = os.path.join(self.download_dir, prefix_list, f"deduplicated-{os.path.basename(filename)}")
+        self._deduplicate_cc(filename, new_filename)
+        ledger.mark(chunk, SegmentLedger.DEDUPLICATED)
+        if self.deduplicator is not None:
+            self.deduplicator.compact()
+        for df_file in df_files + [filename]:
+            if os.path.exists(df_file):
                 os.remove(df_file)
-            # Save to file using the latest name, add prefix combined
-            filename = os.path.join(self.download_dir, prefix_list, f"combined-{os.path.basename(max(df_files))}")
-            pd.concat(df_list, ignore_index=True).to_feather(filename)
-            # Dedupe, add prefix deduplicated
-            new_filename = os.path.join(self.download_dir, prefix_list, f"deduplicated-{os.path.basename(filename)}")
-            self._deduplicate_cc(filename, new_filename)
-            os.remove(filename)
 
-        # ----------------------------------------------------------------------------------------------------------------------#
+    # ----------------------------------------------------------------------------------------------------------------------#
 
-    def lid_cc(self, input_dir, output_dir, region, workers):
-        """Compare classification of 2 language id models (LID), if it is not the same then remove it"""
+    def lid_cc(self, input_dir, output_dir, region, workers, model_path: str = LID_MODEL, batch_size: int = 4096,
+               maxtasksperchild: Optional[int] = None, corpus_format: str = "csv", verify: bool = False):
+        """Compare classification of 2 language id models (LID), if it is not the same then remove it
+
+        Each of the workers processes loads the model once and then takes segments until there are none left (or
+        until it has done maxtasksperchild of them), texts are sent to the model batch_size at a time. Pages are
+        written to output_dir as gzipped csv, or as a partitioned parquet corpus with corpus_format="parquet" (see
+        corpus_store), and the files written are recorded in the manifest of output_dir. With verify, pages are also
+        identified by CLD2 and CLD3 and only kept if all three models agree (see lid_pool)"""
         segment_list = []
         for root, dirs, files in os.walk(os.path.join(input_dir, region)):
             for file in files:
                 file = os.path.join(root, file)
                 segment_list.append(file)
-
-        # Multi-process by file
-        pool_instance = mp.Pool(processes=workers, maxtasksperchild=1)
-        line_list = pool_instance.map(partial(process_lid,
-                                              input_dir=input_dir,
-                                              output_dir=output_dir
-                                              ), segment_list, chunksize=1)
-
-        pool_instance.close()
-        pool_instance.join()
+        os.makedirs("check", exist_ok=True)
+
+        # Multi-process by file, largest segments first so that a big one does not start last
+        segment_list.sort(key=os.path.getsize, reverse=True)
+        if verify:
+            # Raises here if cld2 or cld3 is missing rather than on the first segment of each worker
+            LidPool(workers=0).close()
+        start = time.time()
+        manifest = CorpusManifest(output_dir)
+        with mp.Pool(processes=workers, initializer=_init_lid_worker, initargs=(model_path,),
+                     maxtasksperchild=maxtasksperchild) as pool_instance:
+            for written in tqdm(pool_instance.imap_unordered(partial(_process_lid_task,
+                                                                     verify=verify,
+                                                                     input_dir=input_dir,
+                                                                     output_dir=output_dir,
+                                                                     batch_size=batch_size,
+                                                                     corpus_format=corpus_format
+                                                                     ), segment_list, chunksize=1),
+                          total=len(segment_list), unit="segment", ncols=100):
+                manifest.add_many(written)
+        manifest.close()
+        self.logger.info(f'lid_cc: {len(segment_list)} segments of {region} in {time.time() - start:.0f}s')
 
         # ----------------------------------------------------------------------------------------------------------------------#
 
-    def scan_url_filters(self, dataframe_dir: Union[str, os.PathLike, bytes]):
-        # todo get url filter from file
-        df = pd.read_feather(dataframe_dir)
-        # todo scan url from each dataframe
-            # todo keep track of the domain and its language, if domain contain more than 3 language, add it onto the file
-        # todo pickle the dictionary so that we can keep track of the number of language each domian have, and how many pages it got
-        pass
-
-    def final_cc(self, input_dir, output_dir, region):
-
-            for country in os.listdir(os.path.join(input_dir, region)):
-                for language in os.listdir(os.path.join(input_dir, region, country)):
-
-                    first_flag = True  # First for this set
-                    counter = 1
-
-                    for file in os.listdir(os.path.join(input_dir, region, country, language)):
-
-                        file = os.path.join(input_dir, region, country, language, file)
-                        new_df = pd.read_csv(file, compression="gzip")
-
-                        if first_flag == True:
-                            first_flag = False
-                            current_df = new_df
-                            print("\tFirst time for " + region + " " + country + " " + language)
-
-                        else:
-
-                            # First, merge new_df
-                            print("\tContinuing with " + file)
-                            current_df = pd.concat([current_df, new_df])
-                            current_df.drop_duplicates(subset="URL", keep="first", inplace=False)
-
-                            # Second, check length
-                            if len(current_df) > 100000:
-                                write_df = current_df.head(n=100000)
-                                current_df = current_df.tail(n=len(current_df) - 100000)
-
-                                write_name = region + "." + country + "." + language + "." + str(counter) + ".gz"
-                                write_name = os.path.join(output_dir, region, country, language, write_name)
-                                os.makedirs(os.path.join(output_dir, region, country, language), exist_ok=True)
-                                counter += 1
-
-                                write_df.to_csv(write_name, header=True, index=False, index_label=False,
-                                                compression="gzip")
-                                print("\t\tWriting " + write_name)
-                                del write_df
-
-                    # Done with all files, write the remaining
-                    write_name = region + "." + country + "." + language + "." + str(counter) + ".gz"
-                    write_name = os.path.join(output_dir, region, country, language, write_name)
-                    os.makedirs(os.path.join(output_dir, region, country, language), exist_ok=True)
-                    counter += 1
-
-                    current_df.to_csv(write_name, header=True, index=False, index_label=False, compression="gzip")
-                    print("\t\tWriting " + write_name)
-
-                    del current_df
-
-                    # Done, now delete
-                    for file in os.listdir(os.path.join(input_dir, region, country, language)):
-                        file = os.path.join(input_dir, region, country, language, file)
-                        os.remove(file)
-
-                        # --------------------------------------------------------------------
+    def scan_url_filters(self, dataframe_dir: Union[str, os.PathLike, bytes],
+                         filter_file: Optional[Union[str, os.PathLike]] = None,
+                         state_path: Optional[Union[str, os.PathLike]] = None,
+                         pattern: str = "deduplicated-*.feather",
+                         min_countries: int = 3,
+                         min_languages: Optional[int] = None,
+                         min_pages: int = 0,
+                         workers: Optional[int] = None,
+                         lid_dir: Optional[Union[str, os.PathLike]] = None,
+                         corpus_format: str = "csv") -> Dict[str, Dict[str, int]]:
+        """Count the countries and pages of every site in the processed files under dataframe_dir (or in the single
+        file dataframe_dir) and return the sites crossing the thresholds, written to filter_file if given. Languages
+        are only known once pages went through lid_cc: with lid_dir, the lid_cc outputs under it (in corpus_format)
+        are scanned too and min_languages applies to them (their pages add to the ones of the processed files).
+        Counts are kept in a DomainStats state (download_dir/domain_stats.feather by default): files already counted
+        are not read again, so scanning after each chunk only adds the new files."""
+        if state_path is None:
+            state_path = os.path.join(self.download_dir, "domain_stats.feather")
+        stats = DomainStats(state_path)
+        files = find_files(dataframe_dir, pattern)
+        if lid_dir is not None:
+            files += find_files(lid_dir, "*" + CORPUS_EXTENSIONS[corpus_format])
+        scanned = stats.update(files, workers=workers)
+        filters = stats.url_filters(min_countries=min_countries, min_languages=min_languages, min_pages=min_pages)
+        self.logger.info(f'scan_url_filters: scanned {scanned} new files, {len(stats.files)} in total, '
+                         f'{len(filters)} sites over the thresholds')
+        if filter_file is not None:
+            utilities.write_url_filters_to_file(filter_file, filters)
+        return filters
+
+    def final_cc(self, input_dir, output_dir, region, shard_size: int = 100000, workers: Optional[int] = None,
+                 memory_budget: int = 2 ** 30, corpus_format: str = "csv"):
+        """Merge the files of each country and language of a region into shards of shard_size pages, keeping the
+        first page of every URL, then delete the inputs
+
+        Partitions are independent and run on a pool of workers processes (cpu count by default), largest input
+        first so that the biggest one does not start last. Each task reads its files in blocks sized to fit
+        memory_budget bytes, and no more tasks run at once than the memory of the machine holds. corpus_format is
+        the format of both the inputs and the shards, see corpus_store. The shards are recorded in the manifest of
+        output_dir and the inputs deleted are removed from the manifest of input_dir"""
+        partitions = []
+        inputs = {}
+        for country, language in list_partitions(input_dir, region, corpus_format):
+            files = corpus_files(partition_dir(input_dir, region, country, language, corpus_format), corpus_format)
+            partitions.append((sum(os.path.getsize(file) for file in files), country, language))
+            inputs[(country, language)] = files
+        partitions.sort(reverse=True)
+
+        workers = workers or os.cpu_count()
+        if (memory := _physical_memory()) is not None:
+            workers = max(1, min(workers, memory // memory_budget))
+        # A block of compressed csv expands several times once parsed and converted back for writing
+        block_size = max(2 ** 20, memory_budget // 16)
+        tasks = [(input_dir, output_dir, region, country, language, shard_size, block_size, corpus_format)
+                 for _, country, language in partitions]
+
+        start = time.time()
+        input_manifest = CorpusManifest(input_dir)
+        output_manifest = CorpusManifest(output_dir)
+        with mp.Pool(processes=min(workers, max(1, len(tasks)))) as pool, \
+                tqdm(total=sum(size for size, _, _ in partitions), unit="B", unit_scale=True, ncols=100) as progress:
+            sizes = {(country, language): size for size, country, language in partitions}
+            for country, language, pages, shards, stats, seconds in pool.imap_unordered(_finalize_task, tasks,
+                                                                                         chunksize=1):
+                progress.update(sizes[(country, language)])
+                output_manifest.add_many((shard, region, country, language, stat) for shard, stat in zip(shards, stats))
+                input_manifest.remove(inputs[(country, language)])
+                self.logger.info(f'final_cc: {region}/{country}/{language} {pages} pages into {len(shards)} shards '
+                                  f'in {seconds:.1f}s')
+        input_manifest.close()
+        output_manifest.close()
+        self.logger.info(f'final_cc: {len(tasks)} partitions of {region} on {workers} workers in '
+                         f'{time.time() - start:.0f}s')
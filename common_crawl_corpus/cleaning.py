@@ -0,0 +1,187 @@
+import re
+import string
+import sys
+import unicodedata
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import emoji
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from . import utilities
+
+# Scripts with a shorter minimum line length, as tested by AlphabetDetector.is_cjk / is_hangul / is_hiragana /
+# is_katakana: a line counts as one of them when all of its alphabetic characters have the script in their name
+SHORT_LINE_SCRIPTS = ("CJK", "HANGUL", "HIRAGANA", "KATAKANA")
+
+# Lines with this many or more of a symbol are navigation / boilerplate
+SYMBOL_LIMITS: Dict[str, int] = {"-": 4, "(": 4, ")": 4, "=": 2, "_": 2, ".": 15, "&": 4, "[": 3, "]": 3, "*": 5}
+
+
+def _char_ranges(chars: List[str]) -> List[List[str]]:
+    """Runs of consecutive code points in a sorted list of characters"""
+    ranges = []
+    for char in chars:
+        if ranges and ord(char) == ord(ranges[-1][1]) + 1:
+            ranges[-1][1] = char
+        else:
+            ranges.append([char, char])
+    return ranges
+
+
+def _char_class(chars: List[str]) -> str:
+    """Compact regex character class body for a sorted list of characters"""
+    return "".join(re.escape(first) if first == last else f"{re.escape(first)}-{re.escape(last)}"
+                   for first, last in _char_ranges(chars))
+
+
+def _re2_char_class(chars: List[str]) -> str:
+    """Same as _char_class, in the RE2 syntax used by pyarrow.compute"""
+    return "".join(f"\\x{{{ord(first):x}}}" if first == last else f"\\x{{{ord(first):x}}}-\\x{{{ord(last):x}}}"
+                   for first, last in _char_ranges(chars))
+
+
+class LineCleaner(object):
+    """Cleans and filters the lines of a web page in one go. Gives the same result as the former chain of
+    utilities.strip_tags, utilities.remove_emoji, gensim strip_tags / split_alphanum / strip_multiple_whitespaces
+    and the length, boilerplate character, AlphabetDetector and Counter checks, but everything is compiled once:
+    patterns are only run on lines that contain what they look for, and the script and symbol checks are done
+    with character tables instead of per character Python calls.
+    """
+    # Built on first use and shared by all instances of the process, scanning the unicode tables takes a moment.
+    # The same character classes for re and for the RE2 kernels of pyarrow.compute
+    _script_patterns: Optional[Tuple[Tuple[re.Pattern, ...], Tuple[str, ...]]] = None
+
+    # utilities.strip_tags: links, at-mentions, hashtags, mark-up
+    _LINKS = re.compile(r"http\S+")
+    _MENTIONS = re.compile(r"@\S+")
+    _HASHTAGS = re.compile(r"#\S+")
+    _MARKUP = re.compile("<[^>]*>")
+    # gensim.parsing.preprocessing
+    _TAGS = re.compile(r"<([^>]+)>")
+    _ALPHA_NUM = re.compile(r"([a-z]+)([0-9])")
+    _NUM_ALPHA = re.compile(r"([0-9]+)([a-z])")
+    _WHITESPACES = re.compile(r"(\s)+")
+    _PUNCTUATION = re.compile(r"([%s])+" % re.escape(string.punctuation))
+
+    _DIGITS = frozenset(string.digits)
+    _DELETE_DIGITS = str.maketrans("", "", string.digits)
+    _DELETE_DIGITS_PUNCTUATION = str.maketrans("", "", string.digits + string.punctuation)
+    _ASCII_LETTERS = re.compile("[A-Za-z]")
+    _RE2_PUNCTUATION = f"[{_re2_char_class(sorted(string.punctuation))}]+"
+
+    def __init__(self, min_length: int = 15, min_characters: int = 12, min_length_short_scripts: int = 15,
+                 min_length_other: int = 50, illegal_char=utilities.ILLEGAL_CHAR,
+                 symbol_limits: Optional[Dict[str, int]] = None):
+        self.min_length = min_length
+        self.min_characters = min_characters
+        self.min_length_short_scripts = min_length_short_scripts
+        self.min_length_other = min_length_other
+        self.illegal_char = frozenset(illegal_char)
+        self._re2_illegal_char = f"[{_re2_char_class(sorted(self.illegal_char))}]"
+        self.symbol_limits = tuple((symbol_limits or SYMBOL_LIMITS).items())
+        # every emoji contains at least one non-ascii character, lines without any of them have no emoji
+        self.emoji_char = frozenset(char for key in emoji.EMOJI_DATA for char in key if not char.isascii())
+        if LineCleaner._script_patterns is None:
+            LineCleaner._script_patterns = self._build_script_patterns()
+        self._outside_script, self._re2_outside_script = LineCleaner._script_patterns
+
+    @staticmethod
+    def _build_script_patterns() -> Tuple[Tuple[re.Pattern, ...], Tuple[str, ...]]:
+        """Per short line script, a pattern matching any alphabetic character outside of it"""
+        alpha = [chr(i) for i in range(sys.maxunicode + 1) if chr(i).isalpha()]
+        names = [unicodedata.name(char, "") for char in alpha]
+        outside = [[char for char, name in zip(alpha, names) if script not in name] for script in SHORT_LINE_SCRIPTS]
+        return (tuple(re.compile(f"[{_char_class(chars)}]") for chars in outside),
+                tuple(f"[{_re2_char_class(chars)}]" for chars in outside))
+
+    def _strip(self, line: str) -> str:
+        """Remove links, at-mentions, hashtags, mark-up, emojis and repeated whitespace"""
+        if "http" in line:
+            line = self._LINKS.sub("", line)
+        if "@" in line:
+            line = self._MENTIONS.sub("", line)
+        if "#" in line:
+            line = self._HASHTAGS.sub("", line)
+        if "<" in line:
+            line = self._MARKUP.sub("", line)
+        if not line.isascii() and not self.emoji_char.isdisjoint(line):
+            line = emoji.replace_emoji(line, replace="")
+        if "<" in line:
+            line = self._TAGS.sub("", line)
+        if not self._DIGITS.isdisjoint(line):
+            line = self._NUM_ALPHA.sub(r"\1 \2", self._ALPHA_NUM.sub(r"\1 \2", line))
+        return self._WHITESPACES.sub(" ", line)
+
+    def _is_short_script(self, line: str) -> bool:
+        """True if all alphabetic characters are Chinese, Hangul, Hiragana or Katakana (or there are none)"""
+        if line.isascii():
+            return self._ASCII_LETTERS.search(line) is None
+        if self._ASCII_LETTERS.search(line) is not None:
+            return False
+        return any(pattern.search(line) is None for pattern in self._outside_script)
+
+    def _character_count(self, line: str) -> int:
+        """Length of the line after gensim strip_numeric and strip_punctuation"""
+        return len(self._PUNCTUATION.sub(" ", line.translate(self._DELETE_DIGITS)))
+
+    def clean(self, line: str) -> Optional[str]:
+        """Return the cleaned line, or None if the line is too short, boilerplate or mostly numbers / symbols"""
+        if len(line) <= self.min_length:
+            return None
+        line = self._strip(line)
+        length = len(line)
+        if length <= self.min_length or not self.illegal_char.isdisjoint(line):
+            return None
+        # Characters left without digits and punctuation are a lower bound, only count exactly when it matters
+        if len(line.translate(self._DELETE_DIGITS_PUNCTUATION)) <= self.min_characters \
+                and self._character_count(line) <= self.min_characters:
+            return None
+        if length < self.min_length_other and \
+                (length < self.min_length_short_scripts or not self._is_short_script(line)):
+            return None
+        if any(line.count(symbol) >= limit for symbol, limit in self.symbol_limits):
+            return None
+        return line
+
+    def clean_lines(self, web_content: str) -> List[str]:
+        """Clean all lines of a page, keeping only the accepted ones"""
+        return [line for line in map(self.clean, web_content.splitlines()) if line is not None]
+
+    def keep_mask(self, lines: Sequence[str]) -> np.ndarray:
+        """Vectorized form of the checks clean() runs on stripped lines: lengths, boilerplate characters, digits and
+        punctuation, the script dependent minimum length and the symbol limits are computed over the whole array
+        with pyarrow.compute. Returns a boolean array, True for the lines to keep."""
+        lines = pa.array(lines, type=pa.string())
+        length = pc.utf8_length(lines)
+        keep = pc.and_(pc.greater(length, self.min_length),
+                       pc.invert(pc.match_substring_regex(lines, self._re2_illegal_char)))
+        characters = pc.replace_substring_regex(pc.replace_substring_regex(lines, "[0-9]+", ""),
+                                                self._RE2_PUNCTUATION, " ")
+        keep = pc.and_(keep, pc.greater(pc.utf8_length(characters), self.min_characters))
+        for symbol, limit in self.symbol_limits:
+            keep = pc.and_(keep, pc.less(pc.count_substring(lines, symbol), limit))
+        keep = keep.to_numpy(zero_copy_only=False)
+
+        # Only lines between the two minimum lengths depend on the script
+        length = length.to_numpy(zero_copy_only=False)
+        undecided = np.flatnonzero(keep & (length < self.min_length_other))
+        if len(undecided):
+            candidates = lines.take(pa.array(undecided))
+            short_script = np.zeros(len(undecided), dtype=bool)
+            for pattern in self._re2_outside_script:
+                short_script |= pc.invert(pc.match_substring_regex(candidates, pattern)).to_numpy(zero_copy_only=False)
+            keep[undecided] = short_script & (length[undecided] >= self.min_length_short_scripts)
+        return keep
+
+    def clean_batch(self, lines: Sequence[str]) -> Tuple[np.ndarray, List[str]]:
+        """Clean a batch of lines, e.g. all lines of a record or of a segment. Only the stripping is done line by
+        line, the filters run once over the batch. Returns the positions of the accepted lines and the cleaned lines"""
+        length = pc.utf8_length(pa.array(lines, type=pa.string())).to_numpy(zero_copy_only=False)
+        candidates = np.flatnonzero(length > self.min_length)
+        stripped = [self._strip(lines[i]) for i in candidates]
+        if not stripped:
+            return candidates, stripped
+        keep = self.keep_mask(stripped)
+        return candidates[keep], [line for line, accepted in zip(stripped, keep) if accepted]
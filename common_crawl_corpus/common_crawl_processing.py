@@ -1,11 +1,15 @@
 import os
-import requests
 import gzip
 import pandas as pd
+from functools import partial
 from multiprocessing.pool import ThreadPool
+from typing import List, Optional, Tuple
+from tqdm import tqdm
 
 import logging
 
+from .downloader import Downloader
+
 FILE_DOWNLOAD_DIR = "./common_crawl_download"
 
 logger = logging.getLogger(__name__)
@@ -17,46 +21,75 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 logger.debug('call to common_crawl_corpus made')
 
+# Shared by all downloads of the module, see Downloader for retries and resuming
+downloader = Downloader()
+
 
 def download_index(year_range: str) -> None:
     """
         Downloads the top index file for the given year range.
         e.g. CC-MAIN-2022-40
     """
-    url = f"https://data.commoncrawl.org/crawl-data/{year_range}/wet.paths.gz"
     logger.info('inside download_index')
 
     os.makedirs(os.path.abspath(FILE_DOWNLOAD_DIR), exist_ok=True)
     filepath = os.path.abspath(os.path.join(FILE_DOWNLOAD_DIR, f"{year_range}-wet.paths.gz".strip()))
     logger.debug('filepath of downloaded file: %s', str(filepath))
-    response = requests.get(url)
-    with open(filepath, "wb") as file:
-        file.write(response.content)
+    downloader.download(f"crawl-data/{year_range}/wet.paths.gz", filepath)
 
 
-def download_wet_from_index(index_filename: str):
+def download_wet_from_index(index_filename: str, workers: int = 8, download_dir: str = FILE_DOWNLOAD_DIR,
+                            verify_existing: bool = False) -> List[str]:
     """
-    Scan downloaded index file and download its segments
+    Scan downloaded index file and download its segments, workers at a time, to mirror a crawl on local disk.
+    Segments already downloaded are skipped (with verify_existing, only if their size matches the server's), so an
+    interrupted prefetch picks up where it stopped. Returns the segments that could not be downloaded
     """
     with gzip.open(index_filename, "r") as index:
         lines = [line.decode("utf-8").rstrip() for line in index.readlines()]
-        ThreadPool(8).imap_unordered(download_wet, lines)
+
+    failed = []
+    with ThreadPool(workers) as pool, tqdm(total=len(lines), unit="segment", ncols=100) as progress:
+        for index, error in pool.imap_unordered(partial(_prefetch_wet, download_dir=download_dir,
+                                                        verify_existing=verify_existing), lines):
+            if error is not None:
+                logger.error(f'download_wet_from_index: {index} failed with {error!r}')
+                failed.append(index)
+            progress.set_postfix_str(f"{downloader.stats.rate() / 2 ** 20:.1f}MB/s, {len(failed)} failed")
+            progress.update()
+    logger.info(f'download_wet_from_index: {len(lines) - len(failed)} of {len(lines)} segments, {downloader.stats}')
+    return failed
+
+
+def _prefetch_wet(index: str, download_dir: str, verify_existing: bool) -> Tuple[str, Optional[Exception]]:
+    try:
+        download_wet(index, download_dir=download_dir, verify_existing=verify_existing)
+    except Exception as e:
+        return index, e
+    return index, None
 
 
-def download_wet(index: str):
+def wet_filepath(index: str, download_dir: str = FILE_DOWNLOAD_DIR) -> str:
+    """Local path of a downloaded segment"""
+    return os.path.abspath(os.path.join(download_dir, index.replace("/", "-")).strip())
+
+
+def download_wet(index: str, download_dir: str = FILE_DOWNLOAD_DIR, verify_existing: bool = False) -> str:
     """
         Downloads the second level index file for the given year range.
         e.g. crawl-data/CC-MAIN-2022-40/segments/1664030331677.90/wet/CC-MAIN-20220924151538-20220924181538-00000.warc.wet.gz
+        The body is streamed to disk and its size checked, a file already there is kept
     """
-    url = f"https://data.commoncrawl.org/{index}".strip()
-    logger.info('inside download_wet')
-
-    os.makedirs(os.path.abspath(FILE_DOWNLOAD_DIR), exist_ok=True)
-    filepath = os.path.abspath(os.path.join(FILE_DOWNLOAD_DIR, index.replace("/", "-")).strip())
+    os.makedirs(os.path.abspath(download_dir), exist_ok=True)
+    filepath = wet_filepath(index, download_dir)
+    if os.path.exists(filepath):
+        if not verify_existing or os.path.getsize(filepath) == downloader.size(index):
+            logger.debug('download_wet: %s already downloaded', str(filepath))
+            return filepath
+        os.remove(filepath)
     logger.debug('filepath of download file: %s', str(filepath))
-    response = requests.get(url)
-    with open(filepath, "wb") as file:
-        file.write(response.content)
+    downloader.download(index, filepath)
+    return filepath
 
 
 def save_df(df: pd.DataFrame, filename: str):
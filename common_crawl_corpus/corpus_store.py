@@ -0,0 +1,259 @@
+"""
+Storage of the language-identified corpus (the outputs of lid_cc and final_cc). Two formats:
+- csv: gzipped csv files under root/region/country/language/, as written by pandas.
+- parquet: a hive-partitioned Parquet dataset, root/region=.../country=.../language=.../*.parquet, zstd compressed
+  with row group statistics. read_corpus and iter_corpus_batches only open the partitions asked for and only read the
+  columns asked for, a filter on other columns skips the row groups whose statistics rule it out.
+e.g.
+    table = read_corpus("./cglu", columns=["URL", "N_Words"], region="europe_west", language=["fra", "deu"])
+"""
+
+import multiprocessing as mp
+import os
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+CORPUS_FORMATS = ("csv", "parquet")
+# File extension of a corpus file in each format
+CORPUS_EXTENSIONS = {"csv": ".gz", "parquet": ".parquet"}
+PARTITION_COLUMNS = ("region", "country", "language")
+PARTITIONING = ds.partitioning(pa.schema([(column, pa.string()) for column in PARTITION_COLUMNS]), flavor="hive")
+# Options of every parquet file written, row groups of ROW_GROUP_SIZE rows carry min/max statistics
+PARQUET_OPTIONS = {"compression": "zstd", "write_statistics": True}
+ROW_GROUP_SIZE = 2 ** 16
+
+# Columns of the files written by process_lid, typed up front so that every block of a file is read the same way
+LID_COLUMN_TYPES = {"Time": pa.string(), "URL": pa.string(), "N_Words": pa.int64(), "Text": pa.string(),
+                    "Language": pa.string()}
+
+
+def _check_format(corpus_format: str):
+    if corpus_format not in CORPUS_FORMATS:
+        raise ValueError(f"corpus_format should be one of {CORPUS_FORMATS}, not {corpus_format!r}")
+
+
+def partition_dir(root: Union[str, os.PathLike], region: str, country: str, language: str,
+                  corpus_format: str = "csv") -> str:
+    """Directory of the files of one region/country/language"""
+    _check_format(corpus_format)
+    if corpus_format == "parquet":
+        return os.path.join(root, f"region={region}", f"country={country}", f"language={language}")
+    return os.path.join(root, region, country, language)
+
+
+def list_regions(root: Union[str, os.PathLike], corpus_format: str = "csv") -> List[str]:
+    """Regions of a corpus"""
+    _check_format(corpus_format)
+    hive = corpus_format == "parquet"
+    return sorted(name.partition("=")[2] if hive else name for name in os.listdir(root)
+                  if os.path.isdir(os.path.join(root, name)) and (not hive or name.startswith("region=")))
+
+
+def list_partitions(root: Union[str, os.PathLike], region: str, corpus_format: str = "csv") -> List[Tuple[str, str]]:
+    """(country, language) of the partitions of a region"""
+    _check_format(corpus_format)
+    hive = corpus_format == "parquet"
+    region_dir = os.path.join(root, f"region={region}" if hive else region)
+    partitions = []
+    for country in sorted(os.listdir(region_dir)):
+        if not os.path.isdir(os.path.join(region_dir, country)):
+            continue
+        for language in sorted(os.listdir(os.path.join(region_dir, country))):
+            if os.path.isdir(os.path.join(region_dir, country, language)):
+                partitions.append((country.partition("=")[2] if hive else country,
+                                   language.partition("=")[2] if hive else language))
+    return partitions
+
+
+def corpus_files(directory: Union[str, os.PathLike], corpus_format: str = "csv") -> List[str]:
+    """The corpus files of a partition directory, leaving out files being written"""
+    extension = CORPUS_EXTENSIONS[corpus_format]
+    return sorted(os.path.join(directory, file) for file in os.listdir(directory) if file.endswith(extension))
+
+
+def open_csv(path: Union[str, os.PathLike], block_size: int = 2 ** 24) -> pv.CSVStreamingReader:
+    """Streaming reader over a csv file as written by process_lid (gzipped if its name ends in .gz), block_size
+    bytes at a time"""
+    return pv.open_csv(path, read_options=pv.ReadOptions(block_size=block_size),
+                       parse_options=pv.ParseOptions(newlines_in_values=True),
+                       convert_options=pv.ConvertOptions(column_types=LID_COLUMN_TYPES))
+
+
+def read_csv_batches(path: Union[str, os.PathLike], block_size: int = 2 ** 24) -> Iterator[pa.RecordBatch]:
+    """Record batches of a csv file, see open_csv"""
+    with open_csv(path, block_size) as reader:
+        yield from reader
+
+
+def read_batches(path: Union[str, os.PathLike], block_size: int = 2 ** 24) -> Iterator[pa.RecordBatch]:
+    """Record batches of a corpus file in either format, about block_size bytes of csv or one row group of parquet
+    at a time"""
+    if str(path).endswith(CORPUS_EXTENSIONS["parquet"]):
+        with pq.ParquetFile(path) as parquet_file:
+            yield from parquet_file.iter_batches(batch_size=ROW_GROUP_SIZE)
+    else:
+        yield from read_csv_batches(path, block_size)
+
+
+def word_counts(texts: Union[pa.Array, pa.ChunkedArray]) -> np.ndarray:
+    """Number of words of each text, as str.split() counts them: the empty pieces left by leading or repeated
+    whitespace are left out"""
+    words = pc.utf8_split_whitespace(texts)
+    if isinstance(words, pa.ChunkedArray):
+        words = words.combine_chunks()
+    nonempty = pc.greater(pc.utf8_length(pc.list_flatten(words)), 0).to_numpy(zero_copy_only=False)
+    return np.bincount(pc.list_parent_indices(words).to_numpy()[nonempty], minlength=len(texts))
+
+
+def table_stats(table: Union[pa.Table, pa.RecordBatch, pd.DataFrame]) -> Dict[str, Union[int, str, None]]:
+    """Counts of a corpus table, as kept by the manifest: rows, pages (distinct URLs, rows if there is no URL
+    column), words (the N_Words column, or the words of Text) and crawl (the distinct values of Time, comma
+    separated)"""
+    if isinstance(table, pd.DataFrame):
+        table = pa.Table.from_pandas(table, preserve_index=False)
+    names = table.schema.names
+    if "N_Words" in names:
+        words = pc.sum(table.column("N_Words")).as_py() or 0
+    elif "Text" in names:
+        words = word_counts(table.column("Text").fill_null("")).sum()
+    else:
+        words = 0
+    crawls = pc.unique(table.column("Time")).drop_null().to_pylist() if "Time" in names else []
+    return {"rows": table.num_rows,
+            "pages": len(pc.unique(table.column("URL"))) if "URL" in names else table.num_rows,
+            "words": int(words),
+            "crawl": ",".join(sorted(map(str, crawls))) or None}
+
+
+def merge_stats(stats: Iterable[Dict[str, Union[int, str, None]]]) -> Dict[str, Union[int, str, None]]:
+    """Counts of several tables together, e.g. the batches of one file. Pages add up, as for batches without URLs in
+    common"""
+    stats = list(stats)
+    crawls = {crawl for stat in stats if stat["crawl"] for crawl in stat["crawl"].split(",")}
+    return {"rows": sum(stat["rows"] for stat in stats),
+            "pages": sum(stat["pages"] for stat in stats),
+            "words": sum(stat["words"] for stat in stats),
+            "crawl": ",".join(sorted(crawls)) or None}
+
+
+def file_stats(path: Union[str, os.PathLike]) -> Dict[str, Union[int, str, None]]:
+    """Counts of a corpus file in either format, read batch by batch"""
+    return merge_stats(table_stats(batch) for batch in read_batches(path))
+
+
+def write_parquet(table: Union[pa.Table, pd.DataFrame], path: Union[str, os.PathLike]):
+    """Write a corpus file, under a temporary name first so that path is always complete"""
+    if isinstance(table, pd.DataFrame):
+        table = pa.Table.from_pandas(table, preserve_index=False)
+    pq.write_table(table, f"{path}.tmp", row_group_size=ROW_GROUP_SIZE, **PARQUET_OPTIONS)
+    os.replace(f"{path}.tmp", path)
+
+
+def _selected(name: str, values: Optional[Union[str, Sequence[str]]]) -> bool:
+    value = name.partition("=")[2]
+    return values is None or (value == values if isinstance(values, str) else value in values)
+
+
+def open_corpus(root: Union[str, os.PathLike], region: Optional[Union[str, Sequence[str]]] = None,
+                country: Optional[Union[str, Sequence[str]]] = None,
+                language: Optional[Union[str, Sequence[str]]] = None) -> ds.Dataset:
+    """The parquet corpus under root as a dataset, with region, country and language as partition columns. Only
+    the directories of the partitions selected (a name or a list of names for each) are listed"""
+    directories = [str(root)]
+    for column, values in zip(PARTITION_COLUMNS, (region, country, language)):
+        directories = [os.path.join(directory, name)
+                       for directory in directories for name in sorted(os.listdir(directory))
+                       if name.startswith(f"{column}=") and _selected(name, values)
+                       and os.path.isdir(os.path.join(directory, name))]
+    files = [path for directory in directories for path in corpus_files(directory, "parquet")]
+    return ds.dataset(files, format="parquet", partitioning=PARTITIONING, partition_base_dir=str(root))
+
+
+def corpus_filter(region: Optional[Union[str, Sequence[str]]] = None,
+                  country: Optional[Union[str, Sequence[str]]] = None,
+                  language: Optional[Union[str, Sequence[str]]] = None,
+                  filter: Optional[ds.Expression] = None) -> Optional[ds.Expression]:
+    """Dataset expression selecting the given partitions (a name or a list of names for each), and filter"""
+    expression = filter
+    for column, values in zip(PARTITION_COLUMNS, (region, country, language)):
+        if values is None:
+            continue
+        condition = ds.field(column) == values if isinstance(values, str) else ds.field(column).isin(list(values))
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def read_corpus(root: Union[str, os.PathLike], columns: Optional[List[str]] = None,
+                region: Optional[Union[str, Sequence[str]]] = None,
+                country: Optional[Union[str, Sequence[str]]] = None,
+                language: Optional[Union[str, Sequence[str]]] = None,
+                filter: Optional[ds.Expression] = None) -> pa.Table:
+    """Rows of a parquet corpus as one table: only the partitions selected are opened and only columns are read,
+    filter (e.g. ds.field("N_Words") >= 50) is checked against row group statistics before reading"""
+    return open_corpus(root, region, country, language).to_table(
+        columns=columns, filter=corpus_filter(region, country, language, filter))
+
+
+def iter_corpus_batches(root: Union[str, os.PathLike], columns: Optional[List[str]] = None,
+                        region: Optional[Union[str, Sequence[str]]] = None,
+                        country: Optional[Union[str, Sequence[str]]] = None,
+                        language: Optional[Union[str, Sequence[str]]] = None,
+                        filter: Optional[ds.Expression] = None,
+                        batch_size: int = ROW_GROUP_SIZE) -> Iterator[pa.RecordBatch]:
+    """Same as read_corpus, one record batch at a time"""
+    yield from open_corpus(root, region, country, language).to_batches(
+        columns=columns, filter=corpus_filter(region, country, language, filter), batch_size=batch_size)
+
+
+def _convert_csv_file(task: Tuple[str, str, bool]) -> Dict[str, Union[int, str, None]]:
+    source, target, remove = task
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    stats = []
+    with open_csv(source) as reader, pq.ParquetWriter(f"{target}.tmp", reader.schema, **PARQUET_OPTIONS) as writer:
+        for batch in reader:
+            writer.write_table(pa.Table.from_batches([batch]), row_group_size=ROW_GROUP_SIZE)
+            stats.append(table_stats(batch))
+    os.replace(f"{target}.tmp", target)
+    if remove:
+        os.remove(source)
+    return merge_stats(stats)
+
+
+def convert_csv_corpus(csv_root: Union[str, os.PathLike], corpus_root: Union[str, os.PathLike],
+                       workers: Optional[int] = None, remove: bool = False) -> int:
+    """Convert a csv corpus (root/region/country/language/*.gz) into a parquet corpus, one parquet file per csv
+    file, workers files at a time. Files converted before are skipped, so an interrupted conversion picks up where
+    it stopped; with remove the csv files are deleted once converted. The files converted are recorded in the
+    manifest of corpus_root. Returns the number of files converted"""
+    # manifest builds on this module
+    from .manifest import CorpusManifest
+    tasks = []
+    partitions = []
+    for directory, _, files in os.walk(csv_root):
+        partition = os.path.relpath(directory, csv_root).split(os.sep)
+        if len(partition) != len(PARTITION_COLUMNS):
+            continue
+        for file in sorted(files):
+            if file.endswith(CORPUS_EXTENSIONS["csv"]):
+                target = os.path.join(partition_dir(corpus_root, *partition, corpus_format="parquet"),
+                                      file[:-len(CORPUS_EXTENSIONS["csv"])] + CORPUS_EXTENSIONS["parquet"])
+                if not os.path.exists(target):
+                    tasks.append((os.path.join(directory, file), target, remove))
+                    partitions.append(partition)
+    if not tasks:
+        return 0
+    manifest = CorpusManifest(corpus_root)
+    with mp.Pool(processes=workers) as pool:
+        for (_, target, _), partition, stats in zip(tasks, partitions, tqdm(
+                pool.imap(_convert_csv_file, tasks, chunksize=1), total=len(tasks), unit="file", ncols=100)):
+            manifest.add(target, *partition, stats)
+    manifest.close()
+    return len(tasks)
@@ -9,11 +9,9 @@ import cytoolz as ct
 import multiprocessing as mp
 from functools import partial
 from corpus_similarity.corpus_similarity import Similarity
-import hashlib
 from typing import Iterable, Iterator, Sequence, Sized, Tuple, Type
 
-HASH_TYPE: Type[np.uint64] = np.uint64
-HASH_SIZE = HASH_TYPE(0).nbytes
+from .hashing import line_hash
 
 #---------------------------------------------------------------
 def aggregate(df, chunksize = 5000):
@@ -85,13 +83,10 @@ def aggregate(df, chunksize = 5000):
     return new_df  
  
 #------------------------------------------------------------------
-def _b2i(b):
-    return np.frombuffer(b[:HASH_SIZE], dtype=HASH_TYPE, count=1, offset=0).item(0)
-#------------------------------------------------------------------
-    
 def str_hash(s):
-    h = hashlib.sha1(bytes(s, encoding="utf-8"))
-    return _b2i(h.digest())
+    """Stable 64-bit XXH3 hash of s, the same as the Hash column written by CC_Corpus and WET_processor.
+    It used to be the first 8 bytes of SHA-1: values persisted before the switch are not comparable with it"""
+    return line_hash(s)
 
 #------------------------------------------------------------------
 def deduplicate(df):
@@ -0,0 +1,88 @@
+import logging
+import os
+from typing import Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+from .hash_index import HashIndex
+from .hashing import HASH_TYPE
+from .minhash import MinHasher
+from .url_filter import UrlFilter
+
+logger = logging.getLogger(__name__)
+
+
+class Deduplicator:
+    """This class exists over the lifecycle of a processing run in order to 
+    hold statistics, hashstate for record elimintion between shards and prevent 
+    costly rereading of url lists into the system. It has three main methods, 
+    deduplicate_exact, deduplicate_cluster, deduplicate_international 
+    deduplicate exact removes the exact matching records,
+    deduplicate clusters removes the clusters LSA matching records,
+    dedupliate international removes multinational websites from the records"""
+
+    def __init__(self, index_dir: Union[str, os.PathLike], max_runs: int = 16,
+                 minhasher: Optional[MinHasher] = None, url_filter: Optional[UrlFilter] = None):
+        # Hashes of every line kept so far, on disk so that they carry over between chunks, runs and crawls
+        self.hash_index = HashIndex(index_dir, max_runs=max_runs)
+        # LSH band keys of the lines kept by deduplicate_cluster
+        self.minhasher = minhasher or MinHasher()
+        self.minhash_index = HashIndex(os.path.join(index_dir, "minhash"), max_runs=max_runs)
+        # Multinational sites (utilities.URL_FILTER by default), compiled once for the run and reloaded when its
+        # files change
+        self.url_filter = url_filter or UrlFilter()
+        self.lines_checked = 0
+        self.lines_removed = 0
+        self.near_duplicates_removed = 0
+
+    def deduplicate_exact(self, hashes: np.ndarray, name: str) -> np.ndarray:
+        """Check the line hashes of a shard against all shards seen before and add the new ones in bulk. Returns a
+        boolean array, True for the lines to keep: the first occurrence of hashes not in the index yet.
+        name identifies the shard, deduplicating the same shard again gives the same result"""
+        hashes = np.asarray(hashes, dtype=HASH_TYPE)
+        keep = ~pd.Series(hashes).duplicated(keep="first").to_numpy()
+        keep[keep] = ~self.hash_index.contains(hashes[keep], skip=name)
+        self.hash_index.add(hashes[keep], name=name)
+        self.lines_checked += len(hashes)
+        self.lines_removed += len(hashes) - int(keep.sum())
+        logger.debug(f"deduplicate_exact: {name} removed {len(hashes) - keep.sum()} of {len(hashes)} lines")
+        return keep
+
+    def deduplicate_cluster(self, lines: Sequence[str], name: str, batch_size: int = 2 ** 16) -> np.ndarray:
+        """Flag near-duplicates: lines whose MinHash signature shares an LSH band with a line kept before, in this
+        shard or in any shard seen before. Lines are processed batch_size at a time and only the band keys of the
+        kept lines are stored. Returns a boolean array, True for the lines to keep; the same shard deduplicated again
+        gives the same result"""
+        # A shard done again starts over from the shards before it
+        self.minhash_index.remove(name)
+        keep = np.ones(len(lines), dtype=bool)
+        for batch_number, start in enumerate(range(0, len(lines), batch_size)):
+            keys = self.minhasher.line_keys(lines[start:start + batch_size])
+            batch_keep = ~self.minhash_index.contains(keys.ravel()).reshape(keys.shape).any(axis=1)
+            # Only lines sharing a key with another line of the batch depend on the lines before them, in order and
+            # against the keys of the lines kept so far: a line dropped does not drop the lines similar to it
+            shared = pd.Series(keys.ravel()).duplicated(keep=False).to_numpy().reshape(keys.shape).any(axis=1)
+            kept_keys = set()
+            for line in np.flatnonzero(batch_keep & shared):
+                line_keys = keys[line].tolist()
+                if kept_keys.isdisjoint(line_keys):
+                    kept_keys.update(line_keys)
+                else:
+                    batch_keep[line] = False
+            self.minhash_index.add(keys[batch_keep].ravel(), name=f"{name}.{batch_number}")
+            keep[start:start + batch_size] = batch_keep
+        self.minhash_index.merge_parts(name)
+        self.near_duplicates_removed += len(lines) - int(keep.sum())
+        logger.debug(f"deduplicate_cluster: {name} removed {len(lines) - keep.sum()} of {len(lines)} lines")
+        return keep
+
+    def deduplicate_international(self, urls) -> np.ndarray:
+        """Boolean array over a column of urls, True for the lines to keep: the ones not from multinational sites"""
+        self.url_filter.reload()
+        return ~self.url_filter.mask(urls)
+
+    def compact(self):
+        """Merge the hash runs of the shards done so far, once they are no longer deduplicated again"""
+        self.hash_index.compact()
+        self.minhash_index.compact()
@@ -0,0 +1,123 @@
+import glob
+import json
+import logging
+import multiprocessing as mp
+import os
+from typing import Dict, Iterable, List, Optional, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from . import utilities
+from .corpus_store import read_batches
+
+logger = logging.getLogger(__name__)
+
+# Page counts per site, country and language, the state kept between scans
+STATS_COLUMNS = ["domain", "country", "language", "pages"]
+
+
+def _read_urls(path: Union[str, os.PathLike]) -> pd.DataFrame:
+    """URL, Domain (country code) and Language of the lines of a processed segment (.feather) or of a lid_cc output
+    file (csv or parquet, see corpus_store). Processed segments have no language yet, their Language is "" """
+    if str(path).endswith(".feather"):
+        df = feather.read_table(path, columns=["URL", "Domain"]).to_pandas()
+        df["Language"] = ""
+        return df
+    df = pd.concat([batch.select(["URL", "Language"]).to_pandas() for batch in read_batches(path)],
+                   ignore_index=True)
+    # lid_cc outputs are partitioned by country name, the country code comes from the url as for processed segments
+    df.insert(1, "Domain", [utilities.url_country(url) for url in df["URL"].astype(str)])
+    return df
+
+
+def scan_file(path: Union[str, os.PathLike]) -> pd.DataFrame:
+    """Partial counts of one processed segment or lid_cc output file: the number of distinct pages of each (domain,
+    country, language). The domain is the registered domain as matched by the url filter, the country the country
+    code of the url and the language the Language column of lid_cc outputs ("" for processed segments)"""
+    df = _read_urls(path)
+    df = df.drop_duplicates(subset="URL").astype(str)
+    df["domain"] = [utilities.extract_url(url)[0] for url in df["URL"]]
+    counts = df.groupby(["domain", "Domain", "Language"]).size().reset_index()
+    counts.columns = STATS_COLUMNS
+    return counts[counts["domain"] != ""]
+
+
+def merge_counts(counts: Iterable[pd.DataFrame]) -> pd.DataFrame:
+    """Add up partial counts, in any order or grouping"""
+    counts = [count for count in counts if len(count)]
+    if not counts:
+        return pd.DataFrame({column: pd.Series(dtype=int if column == "pages" else str) for column in STATS_COLUMNS})
+    return pd.concat(counts, ignore_index=True).groupby(STATS_COLUMNS[:-1], as_index=False)["pages"].sum()
+
+
+class DomainStats(object):
+    """
+    Running per-site statistics over the processed outputs of a crawl, the input of the url filter: in how many
+    countries and languages a site has pages, and how many. Languages are only known from lid_cc outputs, the
+    processed segments only count towards countries and pages. update() only scans the files it has not seen yet, in
+    parallel, and adds their counts to the state saved at path, so url filters are rebuilt from the state without
+    reading the corpus again.
+    e.g.
+        stats = DomainStats("./common_crawl_download/domain_stats.feather")
+        stats.update(glob.glob("./common_crawl_download/CC-MAIN-2022-40/deduplicated-*.feather"))
+        stats.update(find_files("./cglu", "*.gz"))
+        utilities.write_url_filters_to_file("url_filter.txt", stats.url_filters(min_countries=3))
+    """
+
+    def __init__(self, path: Union[str, os.PathLike]):
+        self.path = path
+        self.counts = merge_counts([])
+        self.files: List[str] = []
+        if os.path.exists(path):
+            table = feather.read_table(path)
+            self.counts = table.to_pandas()
+            self.files = json.loads(table.schema.metadata[b"files"])
+
+    def update(self, files: Iterable[Union[str, os.PathLike]], workers: Optional[int] = None) -> int:
+        """Scan the files not counted yet and save the new state, return the number of files scanned"""
+        seen = set(self.files)
+        new_files = sorted({os.path.abspath(file) for file in files} - seen - {os.path.abspath(self.path)})
+        if not new_files:
+            return 0
+        with mp.Pool(processes=workers) as pool:
+            partial_counts = list(pool.imap_unordered(scan_file, new_files))
+        self.counts = merge_counts([self.counts] + partial_counts)
+        self.files.extend(new_files)
+        self.save()
+        logger.debug(f'DomainStats: added {len(new_files)} files, {self.counts["domain"].nunique()} sites')
+        return len(new_files)
+
+    def save(self):
+        table = pa.Table.from_pandas(self.counts, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"files": json.dumps(self.files)})
+        feather.write_feather(table, f"{self.path}.tmp")
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def summary(self) -> pd.DataFrame:
+        """Per site: number of countries, of languages and of pages"""
+        languages = self.counts[self.counts["language"] != ""]
+        summary = self.counts.groupby("domain").agg(num_of_countries=("country", "nunique"),
+                                                    num_of_pages=("pages", "sum"))
+        summary["num_of_languages"] = languages.groupby("domain")["language"].nunique()
+        return summary.fillna({"num_of_languages": 0}).astype(int)
+
+    def url_filters(self, min_countries: int = 3, min_languages: Optional[int] = None,
+                    min_pages: int = 0) -> Dict[str, Dict[str, int]]:
+        """Sites with pages in at least min_countries countries (or min_languages languages, which needs lid_cc outputs
+        among the files scanned) and at least min_pages pages, in the format of utilities.write_url_filters_to_file"""
+        summary = self.summary()
+        selected = summary["num_of_countries"] >= min_countries
+        if min_languages is not None:
+            selected |= summary["num_of_languages"] >= min_languages
+        selected &= summary["num_of_pages"] >= min_pages
+        summary = summary[selected].sort_values("num_of_pages", ascending=False)
+        return summary[["num_of_countries", "num_of_pages"]].to_dict(orient="index")
+
+
+def find_files(dataframe_dir: Union[str, os.PathLike], pattern: str = "*.feather") -> List[str]:
+    """The files matching pattern under a directory, or the file itself"""
+    if os.path.isfile(dataframe_dir):
+        return [str(dataframe_dir)]
+    return sorted(glob.glob(os.path.join(dataframe_dir, "**", pattern), recursive=True))
@@ -0,0 +1,249 @@
+import io
+import logging
+import os
+import random
+import threading
+import time
+from typing import Dict, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+CC_BASE_URL = "https://data.commoncrawl.org"
+
+# Errors of a dropped or stalled connection, worth another try
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError, urllib3.exceptions.HTTPError, OSError)
+# Server answers worth another try
+RETRY_STATUS = frozenset((408, 429, 500, 502, 503, 504))
+
+
+class DownloadError(Exception):
+    pass
+
+
+class TransferStats(object):
+    """Bytes and time of the transfers of a Downloader, thread safe"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.seconds = 0.0
+        self.files = 0
+        self.retries = 0
+
+    def add(self, size: int = 0, seconds: float = 0.0, files: int = 0, retries: int = 0):
+        with self._lock:
+            self.bytes += size
+            self.seconds += seconds
+            self.files += files
+            self.retries += retries
+
+    def rate(self) -> float:
+        """Average bytes per second of a transfer"""
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        return (f"{self.files} files, {self.bytes / 2 ** 20:.1f}MB at {self.rate() / 2 ** 20:.1f}MB/s, "
+                f"{self.retries} retries")
+
+
+class Downloader(object):
+    """
+    Download layer shared by CC_Corpus and common_crawl_processing. One pooled requests.Session, at most
+    max_per_host transfers at a time to the same host, timeouts on connect and read, and retries with jittered
+    exponential backoff. Interrupted transfers resume from the last byte received with an HTTP Range request, both
+    for files saved to disk and for segments streamed into ArchiveIterator. Paths are relative to base_url, which can
+    point to a local mirror or a test server.
+    e.g.
+        downloader = Downloader()
+        downloader.download("crawl-data/CC-MAIN-2022-40/wet.paths.gz", "wet.paths.gz")
+        for record in ArchiveIterator(downloader.open("crawl-data/.../CC-MAIN-...warc.wet.gz")):
+            ...
+    """
+
+    def __init__(self, base_url: str = CC_BASE_URL, max_per_host: int = 8, retries: int = 8, backoff: float = 1.0,
+                 max_backoff: float = 60.0, timeout: Tuple[float, float] = (10.0, 60.0), chunk_size: int = 2 ** 20):
+        self.base_url = base_url.rstrip("/")
+        self.max_per_host = max_per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.stats = TransferStats()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_per_host, pool_maxsize=max_per_host)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._host_slots: Dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}/{path.strip().lstrip('/')}"
+
+    def _slot(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_slots[host]
+
+    def _wait(self, attempt: int, url: str, error):
+        if attempt >= self.retries:
+            raise DownloadError(f"{url} failed after {attempt} retries: {error!r}")
+        # Full jitter: uniform between 0 and the exponential cap, so retrying clients spread out
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        logger.warning(f"Downloader: {url} {error!r}, retry {attempt + 1} of {self.retries} in {delay:.1f}s")
+        self.stats.add(retries=1)
+        time.sleep(delay)
+
+    def request(self, url: str, offset: int = 0, stream: bool = True, method: str = "GET") -> requests.Response:
+        """Request with retries, from byte offset on. The response is 206 for a resumed transfer, or 200 if the
+        server ignored the Range header"""
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, url, headers=headers, stream=stream, timeout=self.timeout)
+            except TRANSIENT_ERRORS as e:
+                self._wait(attempt, url, e)
+                attempt += 1
+                continue
+            if response.status_code in RETRY_STATUS:
+                response.close()
+                self._wait(attempt, url, f"HTTP {response.status_code}")
+                attempt += 1
+                continue
+            if response.status_code == 416 and offset:
+                # Nothing left after offset
+                return response
+            response.raise_for_status()
+            return response
+
+    def head(self, path: str) -> Tuple[Optional[int], Optional[str]]:
+        """Size and ETag of a remote file as announced by a HEAD request, None when the server does not say"""
+        with self.request(self.url(path), method="HEAD") as response:
+            length = response.headers.get("Content-Length")
+            etag = response.headers.get("ETag")
+        return int(length) if length is not None and length.isdigit() else None, etag
+
+    def size(self, path: str) -> Optional[int]:
+        """Size of a remote file as announced by a HEAD request, None if the server does not say"""
+        return self.head(path)[0]
+
+    def get(self, path: str) -> bytes:
+        """Whole content of a small file, e.g. a paths index"""
+        with self.open(path) as stream:
+            return stream.read()
+
+    def open(self, path: str) -> "ResumableStream":
+        """Readable binary stream of a remote file that reconnects where it stopped when the connection drops"""
+        return ResumableStream(self, self.url(path))
+
+    def download(self, path: str, destination: Union[str, os.PathLike], expected_size: Optional[int] = None) -> int:
+        """Save a remote file to destination, going through destination.part so that an interrupted download is
+        resumed by the next call. The size is checked against the server's (or expected_size) before the file is
+        moved in place. Returns the size"""
+        part_path = f"{destination}.part"
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        with ResumableStream(self, self.url(path), offset=offset) as stream, \
+                open(part_path, "ab" if offset else "wb") as file:
+            if stream.offset != offset:
+                # The server ignored the Range request and sends the file from the start
+                file.truncate(0)
+            while chunk := stream.read(self.chunk_size):
+                file.write(chunk)
+            size = stream.offset
+            total = stream.total
+        if expected_size is not None and size != expected_size or total is not None and size != total:
+            os.remove(part_path)
+            raise DownloadError(f"{path}: received {size} bytes, expected {expected_size or total}")
+        os.replace(part_path, destination)
+        return size
+
+
+class ResumableStream(io.RawIOBase):
+    """Raw binary stream over an HTTP response. A read interrupted by a transient error reconnects with a Range
+    request from the current offset and carries on, up to the retries of the Downloader. Holds one of the host's
+    transfer slots until closed"""
+
+    def __init__(self, downloader: Downloader, url: str, offset: int = 0):
+        super().__init__()
+        self.downloader = downloader
+        self.url = url
+        self.offset = offset
+        self.total: Optional[int] = None
+        self.etag: Optional[str] = None
+        self._start = time.time()
+        self._received = 0
+        self._slot = downloader._slot(url)
+        self._slot.acquire()
+        try:
+            self._response = self._connect()
+        except BaseException:
+            self._slot.release()
+            raise
+
+    def _connect(self) -> requests.Response:
+        response = self.downloader.request(self.url, offset=self.offset)
+        self.etag = response.headers.get("ETag", self.etag)
+        if response.status_code == 416:
+            self.total = self.offset
+        elif response.status_code == 206:
+            # Content-Range: bytes start-end/total
+            total = response.headers.get("Content-Range", "").rpartition("/")[-1]
+            self.total = int(total) if total.isdigit() else None
+        else:
+            self.offset = 0
+            length = response.headers.get("Content-Length")
+            self.total = int(length) if length is not None and length.isdigit() else None
+        return response
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        attempt = 0
+        while True:
+            if self.total is not None and self.offset >= self.total:
+                return 0
+            try:
+                data = self._response.raw.read(len(buffer))
+                if not data and self.total is not None and self.offset < self.total:
+                    raise urllib3.exceptions.ProtocolError(f"connection closed at byte {self.offset} of {self.total}")
+            except TRANSIENT_ERRORS as e:
+                self._response.close()
+                self.downloader._wait(attempt, self.url, e)
+                attempt += 1
+                resumed_at = self.offset
+                self._response = self._connect()
+                if self.offset != resumed_at:
+                    # The server ignored the Range request, skip what was already read
+                    self._skip(resumed_at)
+                continue
+            buffer[:len(data)] = data
+            self.offset += len(data)
+            self._received += len(data)
+            return len(data)
+
+    def _skip(self, offset: int):
+        while self.offset < offset:
+            data = self._response.raw.read(min(self.downloader.chunk_size, offset - self.offset))
+            if not data:
+                raise urllib3.exceptions.ProtocolError(f"connection closed at byte {self.offset}")
+            self.offset += len(data)
+
+    def close(self):
+        if not self.closed:
+            self._response.close()
+            self._slot.release()
+            seconds = time.time() - self._start
+            self.downloader.stats.add(size=self._received, seconds=seconds, files=1)
+            logger.debug(f"Downloader: {self.url} {self._received / 2 ** 20:.1f}MB "
+                         f"at {self._received / 2 ** 20 / max(seconds, 1e-9):.1f}MB/s")
+        super().close()
@@ -6,65 +6,41 @@
 import os
 import random
 import time
-import cld3
-import cld2
 import psutil
 import gc
 import pandas as pd
-import cytoolz as ct
-import multiprocessing as mp
-from functools import partial
+import pyarrow as pa
+import pyarrow.compute as pc
 
-#-----------------------------------------------
-def get_lid(line, threshold = 150):
-
-	#CLD2
-	if len(line) > threshold:
-		try:
-			isReliable, textBytesFound, details = cld2.detect(line, isPlainText = True)
-			code_cld2 = details[0][1]
-			code_cld2 = mapping_dict[code_cld2]
-		except:
-			code_cld2 = "ukn"
-			
-	#CLD3
-		try:
-			prediction = cld3.get_language(line)
-			code_cld3 = prediction[0]
-			code_cld3 = mapping_dict[code_cld3]
-		except:
-			code_cld3 = "ukn"
-	else:
-		code_cld2 = "ukn"
-		code_cld3 = "ukn"
-
-	return code_cld2, code_cld3
+from common_crawl_corpus.corpus_store import table_stats
+from common_crawl_corpus.lid_pool import LidPool
+from common_crawl_corpus.manifest import CorpusManifest
 
 #-----------------------------------------------
-def process_file(file, language, workers = 64):
+def process_file(file, language, lid_pool):
 
 	start = time.time()
 	
 	while True:
 		try:
-			df = pd.read_csv(file)
+			#Only the text is needed, parquet corpus files (see corpus_store) or csv
+			if file.endswith(".parquet"):
+				df = pd.read_parquet(file, columns = ["Text"])
+			else:
+				df = pd.read_csv(file, usecols = ["Text"])
 			break
 		except Exception as e:
 			print(e)
 			time.sleep(10)
 			
-	pages = df.loc[:,"Text"].values
+	#Lines of all pages as one Arrow array, sent to the LID workers through shared memory
+	pages = pa.array(df.loc[:,"Text"].astype(str), pa.large_string())
 	del df
-	pages = [str(x).split("\n") for x in pages]
-	pages = list(ct.concat(pages))
-
-	#Multi-process
-	pool_instance = mp.Pool(processes = workers, maxtasksperchild = None)
-	codes = pool_instance.map(get_lid, pages, chunksize = 100)
-	pool_instance.close()
-	pool_instance.join()
-	
-	pages = [pages[i] for i in range(len(pages)) if codes[i][0] == language and codes[i][1] == language]
+	pages = pc.list_flatten(pc.split_pattern(pages, "\n"))
+
+	#Keep the lines both CLD2 and CLD3 agree on
+	keep = lid_pool.agree(pages, language)
+	pages = pages.filter(pa.array(keep)).to_pylist()
 	print("\t" + file + "  " + str(time.time() - start) + "  with  " + str(len(pages)))
 	
 	return pages
@@ -73,6 +49,8 @@ def process_file(file, language, workers = 64):
 
 if __name__ == "__main__":
 
+	corpus_root = "cglu"	#Corpus written by lid_cc / final_cc
+	corpus_format = "csv"	#Format of the corpus, "csv" or "parquet" (see corpus_store)
 	temp_folder = "lrec"	#Folder to store temp files, will be cleaned at end
 	country_limit = 150		#Number of files per country to allow
 	langs = ["fra", "spa"]	#List of language codes to process
@@ -107,86 +85,63 @@ if __name__ == "__main__":
 	"Mayotte":"none", "Guinea-Bissau":"none", "Réunion":"none", "Côte_d'Ivoire":"civ", "French_Guiana":"guf", "Monaco":"none", "Jersey":"none", "The_Vatican":"none",
 	"Åland":"none", "Faroe_Islands":"none", "Isle_of_Man":"none", "Gibraltar":"none", "American_Samoa":"none", "Christmas_Island":"none", "Wallis_Futuna":"none"}
 		
-	#Dictionary mapping between ISO-2 and ISO-3 language codes
-	mapping_dict = {"aa":"aar", "ab":"abk", "ae":"ave", "af":"afr", "ak":"aka", "am":"amh", "an":"arg", "ar":"ara", "as":"asm", "av":"ava", "ay":"aym", "az":"aze", 
-	"ba":"bak", "be":"bel", "bg":"bul", "bi":"bis", "bm":"bam", "bn":"ben", "bo":"bod", "bo":"bod", "br":"bre", "bs":"bos", "ca":"cat", "ce":"che", "ch":"cha", 
-	"co":"cos", "cr":"cre", "cs":"ces", "cs":"ces", "cu":"chu", "cv":"chv", "cy":"cym", "cy":"cym", "da":"dan", "de":"deu", "de":"deu", "dv":"div", "dz":"dzo", 
-	"ee":"ewe", "el":"ell", "el":"ell", "en":"eng", "eo":"epo", "es":"spa", "et":"est", "eu":"eus", "eu":"eus", "fa":"fas", "fa":"fas", "ff":"ful", "fi":"fin", 
-	"fj":"fij", "fo":"fao", "fr":"fra", "fr":"fra", "fy":"fry", "ga":"gle", "gd":"gla", "gl":"glg", "gn":"grn", "gu":"guj", "gv":"glv", "ha":"hau", "he":"heb", 
-	"hi":"hin", "ho":"hmo", "hr":"hrv", "ht":"hat", "hu":"hun", "hy":"hye", "hy":"hye", "hz":"her", "ia":"ina", "id":"ind", "ie":"ile", "ig":"ibo", "ii":"iii", 
-	"ik":"ipk", "io":"ido", "is":"isl", "is":"isl", "it":"ita", "iu":"iku", "ja":"jpn", "jv":"jav", "ka":"kat", "ka":"kat", "kg":"kon", "ki":"kik", "kj":"kua", 
-	"kk":"kaz", "kl":"kal", "km":"khm", "kn":"kan", "ko":"kor", "kr":"kau", "ks":"kas", "ku":"kur", "kv":"kom", "kw":"cor", "ky":"kir", "la":"lat", "lb":"ltz", 
-	"lg":"lug", "li":"lim", "ln":"lin", "lo":"lao", "lt":"lit", "lu":"lub", "lv":"lav", "mg":"mlg", "mh":"mah", "mi":"mri", "mi":"mri", "mk":"mkd", "mk":"mkd", 
-	"ml":"mal", "mn":"mon", "mr":"mar", "ms":"msa", "ms":"msa", "mt":"mlt", "my":"mya", "my":"mya", "na":"nau", "nb":"nob", "nd":"nde", "ne":"nep", "ng":"ndo", 
-	"nl":"nld", "nl":"nld", "nn":"nno", "no":"nor", "nr":"nbl", "nv":"nav", "ny":"nya", "oc":"oci", "oj":"oji", "om":"orm", "or":"ori", "os":"oss", "pa":"pan", 
-	"pi":"pli", "pl":"pol", "ps":"pus", "pt":"por", "qu":"que", "rm":"roh", "rn":"run", "ro":"ron", "ro":"ron", "ru":"rus", "rw":"kin", "sa":"san", "sc":"srd", 
-	"sd":"snd", "se":"sme", "sg":"sag", "si":"sin", "sk":"slk", "sk":"slk", "sl":"slv", "sm":"smo", "sn":"sna", "so":"som", "sq":"sqi", "sq":"sqi", "sr":"srp", 
-	"ss":"ssw", "st":"sot", "su":"sun", "sv":"swe", "sw":"swa", "ta":"tam", "te":"tel", "tg":"tgk", "th":"tha", "ti":"tir", "tk":"tuk", "tl":"tgl", "tn":"tsn", 
-	"to":"ton", "tr":"tur", "ts":"tso", "tt":"tat", "tw":"twi", "ty":"tah", "ug":"uig", "uk":"ukr", "ur":"urd", "uz":"uzb", "ve":"ven", "vi":"vie", "vo":"vol", 
-	"wa":"wln", "wo":"wol", "xh":"xho", "yi":"yid", "yo":"yor", "za":"zha", "zh":"zho", "zh":"zho", "zu":"zul", "un":"unk"}
-	
+	#Language identification workers, started once for the whole run
+	lid_pool = LidPool(workers = 64)
+
+	#Counts of the corpus files, brought up to date first if the corpus was written without a manifest
+	manifest = CorpusManifest(corpus_root)
+	manifest.scan(corpus_format)
+	#GeoCorpus files mix the countries of a language, they are recorded without region or country
+	output_manifest = CorpusManifest(".")
+
 	for lang in langs:
-		for region in os.listdir("cglu"):
-			if "." not in region:
-						
-				for country in os.listdir(os.path.join("cglu", region)):
-					if "." not in country:
-						
-						try:
-							nav_list = os.listdir(os.path.join("cglu", region, country))
-						except Exception as e:
-							print(e)
-							nav_list = []
+		partitions = manifest.partitions(language = lang)
+		for region, country in zip(partitions.loc[:,"region"], partitions.loc[:,"country"]):
+			language = lang
+			new_lines = []
+			files = [os.path.join(corpus_root, x) for x in manifest.files(region, country, language).loc[:,"path"]]
+			random.shuffle(files)
+			
+			if len(files) > country_limit:
+				files = random.sample(files, country_limit)
+
+			country_name = iso_dict[country]
+			os.makedirs(os.path.join(temp_folder, language), exist_ok = True)
+			write_name = os.path.join(temp_folder, language, language + "." + country + ".INSERT.csv")
+			
+			if not os.path.isfile(write_name.replace("INSERT","1")):
+				if country_name != "none":
+				
+					#print("\tStarting " + country_name + " with " + str(len(files)) + " files.")
+					write_counter = 1
+					
+					for file in files:
+						new_lines += process_file(file, language, lid_pool)
 						
-						for language in nav_list:						
-							if "." not in language:
-								if lang == language:
-								
-									new_lines = []
-									files = []
-									files = os.listdir(os.path.join("cglu", region, country, language))
-									files = [os.path.join("cglu", region, country, language, x) for x in files if x.endswith(".gz")]
-									random.shuffle(files)
-									
-									if len(files) > country_limit:
-										files = random.sample(files, country_limit)
-									country_name = iso_dict[country]
-									os.makedirs(os.path.join(temp_folder, language), exist_ok = True)
-									write_name = os.path.join(temp_folder, language, language + "." + country + ".INSERT.csv")
+						if len(new_lines) > 5000000:
+							new_df = pd.DataFrame(new_lines)
+							new_df.columns = ["Text"]
+							new_df.loc[:,"Country"] = country
+							new_df.loc[:,"Language"] = language
+							new_df.drop_duplicates(subset = "Text", keep = "first", inplace = True)
+							new_df.to_csv(write_name.replace("INSERT",str(write_counter)))
+							del new_df
+							new_lines = []
+							write_counter += 1
+													
 									
-									if not os.path.isfile(write_name.replace("INSERT","1")):
-										if country_name != "none":
-										
-											#print("\tStarting " + country_name + " with " + str(len(files)) + " files.")
-											write_counter = 1
-											
-											for file in files:
-												new_lines += process_file(file, language)
-												
-												if len(new_lines) > 5000000:
-													new_df = pd.DataFrame(new_lines)
-													new_df.columns = ["Text"]
-													new_df.loc[:,"Country"] = country
-													new_df.loc[:,"Language"] = language
-													new_df.drop_duplicates(subset = "Text", keep = "first", inplace = True)
-													new_df.to_csv(write_name.replace("INSERT",str(write_counter)))
-													del new_df
-													new_lines = []
-													write_counter += 1
-																			
-															
-											#Done with files
-											if len(new_lines) > 1000:
-												new_df = pd.DataFrame(new_lines)
-												new_df.columns = ["Text"]
-												new_df.loc[:,"Country"] = country
-												new_df.loc[:,"Language"] = language
-												new_df.drop_duplicates(subset = "Text", keep = "first", inplace = True)
-												new_df.to_csv(write_name.replace("INSERT",str(write_counter)))
-												#print("\t\t", write_name)
-												del new_lines
-												del new_df
-											
+					#Done with files
+					if len(new_lines) > 1000:
+						new_df = pd.DataFrame(new_lines)
+						new_df.columns = ["Text"]
+						new_df.loc[:,"Country"] = country
+						new_df.loc[:,"Language"] = language
+						new_df.drop_duplicates(subset = "Text", keep = "first", inplace = True)
+						new_df.to_csv(write_name.replace("INSERT",str(write_counter)))
+						#print("\t\t", write_name)
+						del new_lines
+						del new_df
+					
 		print("Done with " + lang)
 		data = []
 		file_counter = 1
@@ -220,6 +175,7 @@ if __name__ == "__main__":
 					print(str(sum(words_list)))
 					
 					data.to_csv("GeoCorpus." + lang + "." + str(file_counter) + ".gz", compression = "gzip")
+					output_manifest.add("GeoCorpus." + lang + "." + str(file_counter) + ".gz", "", "", lang, table_stats(data))
 					file_counter += 1
 					del data
 					data = []
@@ -243,10 +199,15 @@ if __name__ == "__main__":
 		print(str(sum(words_list)))
 		
 		data.to_csv("GeoCorpus." + lang + "." + str(file_counter) + ".gz", compression = "gzip")
+		output_manifest.add("GeoCorpus." + lang + "." + str(file_counter) + ".gz", "", "", lang, table_stats(data))
 		del data
 		
 		#Clean
 		for file in os.listdir(os.path.join(".", temp_folder, lang)):
 			os.remove(os.path.join(".", temp_folder, lang, file))
 			
-		gc.collect()
\ No newline at end of file
+		gc.collect()
+
+	lid_pool.close()
+	manifest.close()
+	output_manifest.close()
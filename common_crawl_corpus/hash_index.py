@@ -0,0 +1,117 @@
+import glob
+import math
+import os
+import time
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+
+from .hashing import HASH_TYPE
+
+
+class HashIndex(object):
+    """Persistent set of line hashes on disk, shared by all chunks and crawls processed against the same directory.
+
+    The set is a handful of runs, sorted arrays of unique hashes saved as .npy files and memory-mapped for lookups,
+    so only the pages touched by a binary search are read. Every insert writes one new run named after the chunk it
+    comes from; compact() merges runs of similar size, those of a size tier (a factor of max_runs) once there are more
+    than max_runs of them. A hash is rewritten once per tier it moves up, about log(hashes) / log(max_runs) times.
+    Memory use while checking a chunk is proportional to the chunk, disk use to the number of unique lines seen.
+    e.g.
+        index = HashIndex("./common_crawl_download/hash_index")
+        keep = ~index.contains(hashes)
+        index.add(hashes[keep], name="combined-CC-MAIN-...")
+    """
+
+    def __init__(self, path: Union[str, os.PathLike], max_runs: int = 16):
+        if max_runs < 2:
+            raise ValueError(f"max_runs ({max_runs}) must be at least 2")
+        self.path = path
+        self.max_runs = max_runs
+        os.makedirs(path, exist_ok=True)
+
+    def _run_path(self, name: str) -> str:
+        return os.path.join(self.path, f"{name}.npy")
+
+    def _runs(self, skip: Optional[str] = None) -> List[np.ndarray]:
+        skip_path = None if skip is None else self._run_path(skip)
+        return [np.load(run_path, mmap_mode="r") for run_path in sorted(glob.glob(os.path.join(self.path, "*.npy")))
+                if run_path != skip_path]
+
+    def __len__(self) -> int:
+        return sum(len(run) for run in self._runs())
+
+    def contains(self, hashes: np.ndarray, skip: Optional[str] = None) -> np.ndarray:
+        """Boolean array, True for the hashes already in the index. The run named skip is left out, so that a chunk
+        redone after an interruption is not matched against its own lines"""
+        hashes = np.asarray(hashes, dtype=HASH_TYPE)
+        found = np.zeros(len(hashes), dtype=bool)
+        if not len(hashes):
+            return found
+        # Searching in sorted order keeps the reads of the memory-mapped runs moving forward
+        order = np.argsort(hashes, kind="stable")
+        queries = hashes[order]
+        for run in self._runs(skip):
+            positions = np.minimum(np.searchsorted(run, queries), len(run) - 1)
+            found[order] |= run[positions] == queries
+        return found
+
+    def add(self, hashes: np.ndarray, name: str):
+        """Store hashes as the run name, replacing a previous run of the same name"""
+        hashes = np.unique(np.asarray(hashes, dtype=HASH_TYPE))
+        run_path = self._run_path(name)
+        if not len(hashes):
+            if os.path.exists(run_path):
+                os.remove(run_path)
+            return
+        self._save(hashes, run_path)
+
+    def _part_paths(self, name: str) -> List[str]:
+        return glob.glob(os.path.join(glob.escape(self.path), f"{glob.escape(name)}.*.npy"))
+
+    def merge_parts(self, name: str):
+        """Combine the runs name.0, name.1, ... added while processing a chunk batch by batch into the run name"""
+        part_paths = self._part_paths(name)
+        if part_paths:
+            self.add(np.concatenate([np.load(part_path, mmap_mode="r") for part_path in part_paths]), name=name)
+            for part_path in part_paths:
+                os.remove(part_path)
+
+    def remove(self, name: str):
+        """Drop the run name and its parts"""
+        for run_path in self._part_paths(name) + [self._run_path(name)]:
+            if os.path.exists(run_path):
+                os.remove(run_path)
+
+    def _tier(self, run_path: str) -> int:
+        return int(math.log(max(len(np.load(run_path, mmap_mode="r")), 1), self.max_runs))
+
+    def compact(self, force: bool = False):
+        """Merge the runs of a size tier into one when there are more than max_runs of them, smallest tier first
+        and again for the tier above as long as one is over (or all runs into one, with force)"""
+        run_paths = sorted(glob.glob(os.path.join(self.path, "*.npy")))
+        if force:
+            if len(run_paths) > 1:
+                self._merge(run_paths)
+            return
+        tiers: Dict[int, List[str]] = {}
+        for run_path in run_paths:
+            tiers.setdefault(self._tier(run_path), []).append(run_path)
+        while full_tiers := [tier for tier, tier_paths in tiers.items() if len(tier_paths) > self.max_runs]:
+            merged_path = self._merge(tiers.pop(min(full_tiers)))
+            tiers.setdefault(self._tier(merged_path), []).append(merged_path)
+
+    def _merge(self, run_paths: List[str]) -> str:
+        merged = np.unique(np.concatenate([np.load(run_path, mmap_mode="r") for run_path in run_paths]))
+        # The merged run is complete on disk before the old ones go, hashes in both are harmless
+        merged_path = self._run_path(f"compacted-{time.time_ns()}")
+        self._save(merged, merged_path)
+        for run_path in run_paths:
+            os.remove(run_path)
+        return merged_path
+
+    @staticmethod
+    def _save(hashes: np.ndarray, run_path: str):
+        with open(f"{run_path}.tmp", "wb") as file:
+            np.save(file, hashes)
+        os.replace(f"{run_path}.tmp", run_path)
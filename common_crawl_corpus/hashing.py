@@ -0,0 +1,27 @@
+import hashlib
+from typing import Sequence, Type
+
+import numpy as np
+import xxhash
+
+# Line hashes are unsigned 64 bit integers, the Hash column of processed segments
+HASH_TYPE: Type[np.uint64] = np.uint64
+HASH_SIZE = HASH_TYPE(0).nbytes
+
+
+def line_hash(line: str) -> int:
+    """Stable 64 bit hash of a line (XXH3 of its UTF-8 bytes). Unlike the built-in hash(), which is salted per
+    process by PYTHONHASHSEED, it gives the same value in every worker, run and machine, so hashes of different
+    segments and crawls can be compared."""
+    return xxhash.xxh3_64_intdigest(line.encode("utf-8"))
+
+
+def hash_lines(lines: Sequence[str]) -> np.ndarray:
+    """line_hash of every line, as an array of HASH_TYPE"""
+    digest = xxhash.xxh3_64_intdigest
+    return np.array([digest(line.encode("utf-8")) for line in lines], dtype=HASH_TYPE)
+
+
+def sha1_hash(line: str) -> int:
+    """First 64 bits of the SHA-1 of a line, the former deduplication.str_hash, kept for comparison"""
+    return int.from_bytes(hashlib.sha1(line.encode("utf-8")).digest()[:HASH_SIZE], byteorder="little")
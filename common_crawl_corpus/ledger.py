@@ -0,0 +1,71 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Optional, Union
+
+
+class SegmentLedger(object):
+    """Durable record of where every segment of a crawl is in the processing, kept as a SQLite file next to the
+    downloaded data (download_dir/CC-MAIN-YYYY-WW/ledger.sqlite). A restarted run reads it to skip finished work
+    and retry only the segments that failed or never finished.
+
+    A segment goes pending -> downloaded -> processed -> merged -> deduplicated, or to failed on error.
+    """
+    PENDING = "pending"
+    DOWNLOADED = "downloaded"
+    PROCESSED = "processed"
+    MERGED = "merged"
+    DEDUPLICATED = "deduplicated"
+    FAILED = "failed"
+
+    # States in which a segment still has to be downloaded and processed
+    TODO = (PENDING, DOWNLOADED, FAILED)
+
+    def __init__(self, path: Union[str, os.PathLike]):
+        self.path = path
+        # Download threads of the pipelined mode share the connection
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS segments ("
+                                     "segment TEXT PRIMARY KEY, "
+                                     "state TEXT NOT NULL, "
+                                     "attempts INTEGER NOT NULL DEFAULT 0, "
+                                     "error TEXT, "
+                                     "updated REAL NOT NULL)")
+
+    def add_segments(self, segments: Iterable[str]):
+        """Register segments as pending, segments already in the ledger keep their state"""
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR IGNORE INTO segments (segment, state, updated) VALUES (?, ?, ?)",
+                                         [(segment, self.PENDING, now) for segment in segments])
+
+    def states(self, segments: Iterable[str]) -> Dict[str, str]:
+        """Current state of each of the given segments"""
+        segments = list(segments)
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT segment, state FROM segments WHERE segment IN ({', '.join('?' * len(segments))})",
+                segments).fetchall()
+        return dict(rows)
+
+    def mark(self, segments: Iterable[str], state: str, error: Optional[str] = None):
+        """Move segments to a new state in one transaction, failures count as an attempt and keep the error"""
+        now = time.time()
+        attempt = 1 if state == self.FAILED else 0
+        with self._lock, self._connection:
+            self._connection.executemany("UPDATE segments SET state = ?, attempts = attempts + ?, error = ?, "
+                                         "updated = ? WHERE segment = ?",
+                                         [(state, attempt, error, now, segment) for segment in segments])
+
+    def summary(self) -> Dict[str, int]:
+        """Number of segments in each state"""
+        with self._lock:
+            return dict(self._connection.execute("SELECT state, COUNT(*) FROM segments GROUP BY state").fetchall())
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
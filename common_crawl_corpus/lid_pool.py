@@ -0,0 +1,180 @@
+import multiprocessing as mp
+import sys
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Optional, Sequence, Union
+
+import numpy as np
+import pyarrow as pa
+
+# ISO 639-1 codes of CLD2 and CLD3 to the ISO 639-3 codes of the corpus
+ISO_639_3 = {
+    "aa": "aar", "ab": "abk", "ae": "ave", "af": "afr", "ak": "aka", "am": "amh", "an": "arg", "ar": "ara", "as": "asm",
+    "av": "ava", "ay": "aym", "az": "aze", "ba": "bak", "be": "bel", "bg": "bul", "bi": "bis", "bm": "bam", "bn": "ben",
+    "bo": "bod", "br": "bre", "bs": "bos", "ca": "cat", "ce": "che", "ch": "cha", "co": "cos", "cr": "cre", "cs": "ces",
+    "cu": "chu", "cv": "chv", "cy": "cym", "da": "dan", "de": "deu", "dv": "div", "dz": "dzo", "ee": "ewe", "el": "ell",
+    "en": "eng", "eo": "epo", "es": "spa", "et": "est", "eu": "eus", "fa": "fas", "ff": "ful", "fi": "fin", "fj": "fij",
+    "fo": "fao", "fr": "fra", "fy": "fry", "ga": "gle", "gd": "gla", "gl": "glg", "gn": "grn", "gu": "guj", "gv": "glv",
+    "ha": "hau", "he": "heb", "hi": "hin", "ho": "hmo", "hr": "hrv", "ht": "hat", "hu": "hun", "hy": "hye", "hz": "her",
+    "ia": "ina", "id": "ind", "ie": "ile", "ig": "ibo", "ii": "iii", "ik": "ipk", "io": "ido", "is": "isl", "it": "ita",
+    "iu": "iku", "ja": "jpn", "jv": "jav", "ka": "kat", "kg": "kon", "ki": "kik", "kj": "kua", "kk": "kaz", "kl": "kal",
+    "km": "khm", "kn": "kan", "ko": "kor", "kr": "kau", "ks": "kas", "ku": "kur", "kv": "kom", "kw": "cor", "ky": "kir",
+    "la": "lat", "lb": "ltz", "lg": "lug", "li": "lim", "ln": "lin", "lo": "lao", "lt": "lit", "lu": "lub", "lv": "lav",
+    "mg": "mlg", "mh": "mah", "mi": "mri", "mk": "mkd", "ml": "mal", "mn": "mon", "mr": "mar", "ms": "msa", "mt": "mlt",
+    "my": "mya", "na": "nau", "nb": "nob", "nd": "nde", "ne": "nep", "ng": "ndo", "nl": "nld", "nn": "nno", "no": "nor",
+    "nr": "nbl", "nv": "nav", "ny": "nya", "oc": "oci", "oj": "oji", "om": "orm", "or": "ori", "os": "oss", "pa": "pan",
+    "pi": "pli", "pl": "pol", "ps": "pus", "pt": "por", "qu": "que", "rm": "roh", "rn": "run", "ro": "ron", "ru": "rus",
+    "rw": "kin", "sa": "san", "sc": "srd", "sd": "snd", "se": "sme", "sg": "sag", "si": "sin", "sk": "slk", "sl": "slv",
+    "sm": "smo", "sn": "sna", "so": "som", "sq": "sqi", "sr": "srp", "ss": "ssw", "st": "sot", "su": "sun", "sv": "swe",
+    "sw": "swa", "ta": "tam", "te": "tel", "tg": "tgk", "th": "tha", "ti": "tir", "tk": "tuk", "tl": "tgl", "tn": "tsn",
+    "to": "ton", "tr": "tur", "ts": "tso", "tt": "tat", "tw": "twi", "ty": "tah", "ug": "uig", "uk": "ukr", "ur": "urd",
+    "uz": "uzb", "ve": "ven", "vi": "vie", "vo": "vol", "wa": "wln", "wo": "wol", "xh": "xho", "yi": "yid", "yo": "yor",
+    "za": "zha", "zh": "zho", "zu": "zul", "un": "unk"}
+# Code of lines too short or that a model could not identify
+UNKNOWN = "ukn"
+# Languages as returned by detect, an index into CODES per line and model
+CODES: List[str] = [UNKNOWN] + sorted(set(ISO_639_3.values()))
+_CODE_INDEX = {code: index for index, code in enumerate(CODES)}
+
+# cld2 and cld3 modules, imported on first use so that the package does not depend on them
+_cld2 = None
+_cld3 = None
+
+
+def _load_detectors():
+    global _cld2, _cld3
+    if _cld2 is None:
+        import cld2
+        import cld3
+        _cld2, _cld3 = cld2, cld3
+
+
+def detect_languages(lines: Sequence[str], threshold: int = 150) -> np.ndarray:
+    """CLD2 and CLD3 language of each line, in this process: an array of (cld2, cld3) indexes into CODES, UNKNOWN
+    for lines of threshold characters or fewer"""
+    _load_detectors()
+    codes = np.zeros((len(lines), 2), dtype=np.uint16)
+    for index, line in enumerate(lines):
+        if len(line) <= threshold:
+            continue
+        try:
+            details = _cld2.detect(line, isPlainText=True)[2]
+            codes[index, 0] = _CODE_INDEX.get(ISO_639_3.get(details[0][1]), 0)
+        except Exception:
+            pass
+        try:
+            codes[index, 1] = _CODE_INDEX.get(ISO_639_3.get(_cld3.get_language(line)[0]), 0)
+        except Exception:
+            pass
+    return codes
+
+
+def _write_shared(batch: pa.RecordBatch) -> SharedMemory:
+    """A new block of shared memory holding batch as an Arrow stream"""
+    size = pa.MockOutputStream()
+    with pa.ipc.new_stream(size, batch.schema) as writer:
+        writer.write_batch(batch)
+    shared = SharedMemory(create=True, size=size.size())
+    sink = pa.FixedSizeBufferWriter(pa.py_buffer(shared.buf))
+    with pa.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    sink.close()
+    return shared
+
+
+def _read_shared(shared: SharedMemory, start: int, end: int) -> List[str]:
+    # Every view of the shared memory is gone once this returns, as close() requires
+    with pa.ipc.open_stream(pa.py_buffer(shared.buf)) as reader:
+        return reader.read_next_batch().column(0).slice(start, end - start).to_pylist()
+
+
+def _attach_shared(name: str) -> SharedMemory:
+    """The block of shared memory of a LidPool, which the parent process owns and unlinks"""
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name=name, track=False)
+    # The workers share the resource tracker of the parent (see LidPool), where the block is already registered until
+    # the parent unlinks it: attaching leaves nothing behind for the tracker to clean up
+    return SharedMemory(name=name)
+
+
+def _detect_shared(task) -> np.ndarray:
+    """detect_languages in a LidPool worker, on lines start to end of the batch in shared memory"""
+    name, start, end, threshold = task
+    shared = _attach_shared(name)
+    try:
+        lines = _read_shared(shared, start, end)
+    finally:
+        shared.close()
+    return detect_languages(lines, threshold)
+
+
+class LidPool(object):
+    """
+    Persistent pool of CLD2/CLD3 language identification workers, started once and fed large batches of lines.
+    The lines of a call to detect are written once to shared memory as an Arrow batch, each worker reads its
+    slice of batch_size lines from there and returns a compact array of codes, so that nothing but a name and two
+    offsets goes to the workers and two integers per line come back. With workers=0 lines are identified in the
+    calling process, e.g. inside a worker of another pool.
+    e.g.
+        with LidPool(workers=64) as lid_pool:
+            for file in files:
+                keep = lid_pool.agree(lines, "fra")
+    """
+
+    def __init__(self, workers: Optional[int] = None, threshold: int = 150, batch_size: int = 2 ** 14):
+        self.threshold = threshold
+        self.batch_size = batch_size
+        # Fails here rather than in the initializer of each worker, which the pool would restart forever
+        _load_detectors()
+        self._pool = None
+        if workers != 0:
+            # Started before the workers so that they inherit it instead of starting their own
+            resource_tracker.ensure_running()
+            self._pool = mp.Pool(processes=workers, initializer=_load_detectors)
+
+    def detect(self, lines: Union[Sequence[str], pa.Array, pa.ChunkedArray]) -> np.ndarray:
+        """(cld2, cld3) indexes into CODES of each line, see detect_languages"""
+        if self._pool is None:
+            if isinstance(lines, (pa.Array, pa.ChunkedArray)):
+                lines = lines.to_pylist()
+            return detect_languages(lines, self.threshold)
+        if isinstance(lines, pa.ChunkedArray):
+            lines = lines.combine_chunks()
+        lines = pa.array(lines, pa.large_string()) if not isinstance(lines, pa.Array) else lines.cast(pa.large_string())
+        if not len(lines):
+            return np.zeros((0, 2), dtype=np.uint16)
+        shared = _write_shared(pa.record_batch([lines], names=["Text"]))
+        try:
+            tasks = [(shared.name, start, min(start + self.batch_size, len(lines)), self.threshold)
+                     for start in range(0, len(lines), self.batch_size)]
+            return np.concatenate(self._pool.map(_detect_shared, tasks, chunksize=1))
+        finally:
+            shared.close()
+            shared.unlink()
+
+    def agree(self, lines: Union[Sequence[str], pa.Array, pa.ChunkedArray],
+              languages: Union[str, Sequence[str]]) -> np.ndarray:
+        """Mask of the lines that both CLD2 and CLD3 identify as their language (one for all, or one per line)"""
+        codes = self.detect(lines)
+        if isinstance(languages, str):
+            expected = _CODE_INDEX.get(languages, -1)
+        else:
+            expected = np.array([_CODE_INDEX.get(language, -1) for language in languages])
+        return (codes[:, 0] == expected) & (codes[:, 1] == expected)
+
+    @staticmethod
+    def languages(codes: np.ndarray) -> np.ndarray:
+        """Language codes of an array of indexes into CODES"""
+        return np.array(CODES)[codes]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,130 @@
+import multiprocessing as mp
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, Optional, Tuple, Union
+
+import pandas as pd
+
+from .corpus_store import PARTITION_COLUMNS, corpus_files, file_stats, list_partitions, list_regions, partition_dir
+
+# Counts kept for every file, added up per partition
+COUNT_COLUMNS = ("rows", "pages", "words", "bytes")
+
+
+class CorpusManifest(object):
+    """
+    Counts of every file of a corpus (rows, pages, words, bytes and the crawls it comes from), kept as a SQLite file
+    at the root of the corpus (root/manifest.sqlite) by the stages that write it: lid_cc, final_cc and
+    corpus_store.convert_csv_corpus. How much a country or language has is a query on the manifest instead of a read
+    of the corpus; scan() brings the manifest of a corpus written without it up to date.
+    e.g.
+        manifest = CorpusManifest("./cglu")
+        manifest.words("europe_west", "fr", "fra")
+        manifest.partitions(region="europe_west")
+    """
+
+    def __init__(self, root: Union[str, os.PathLike]):
+        self.root = root
+        self.path = os.path.join(root, "manifest.sqlite")
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=60)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS files ("
+                                     "path TEXT PRIMARY KEY, "
+                                     "region TEXT NOT NULL, "
+                                     "country TEXT NOT NULL, "
+                                     "language TEXT NOT NULL, "
+                                     "rows INTEGER NOT NULL, "
+                                     "pages INTEGER NOT NULL, "
+                                     "words INTEGER NOT NULL, "
+                                     "bytes INTEGER NOT NULL, "
+                                     "crawl TEXT, "
+                                     "mtime REAL NOT NULL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS partitions ON files (region, country, language)")
+
+    def _relative(self, path: Union[str, os.PathLike]) -> str:
+        return os.path.relpath(path, self.root)
+
+    def add(self, path: Union[str, os.PathLike], region: str, country: str, language: str,
+            stats: Dict[str, Union[int, str, None]]):
+        """Record a file written under root with its counts (see table_stats), replacing a previous record"""
+        self.add_many([(path, region, country, language, stats)])
+
+    def add_many(self, files: Iterable[Tuple[Union[str, os.PathLike], str, str, str, Dict]]):
+        """Record several (path, region, country, language, stats) in one transaction"""
+        rows = [(self._relative(path), region, country, language, stats["rows"], stats["pages"], stats["words"],
+                 os.path.getsize(path), stats["crawl"], os.path.getmtime(path))
+                for path, region, country, language, stats in files]
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO files (path, region, country, language, rows, pages, "
+                                         "words, bytes, crawl, mtime) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def remove(self, paths: Iterable[Union[str, os.PathLike]]):
+        """Forget files deleted from the corpus"""
+        with self._lock, self._connection:
+            self._connection.executemany("DELETE FROM files WHERE path = ?",
+                                         [(self._relative(path),) for path in paths])
+
+    def _select(self, query: str, region: Optional[str], country: Optional[str], language: Optional[str],
+                suffix: str = "") -> pd.DataFrame:
+        conditions = [(column, value) for column, value in zip(PARTITION_COLUMNS, (region, country, language))
+                      if value is not None]
+        where = " WHERE " + " AND ".join(f"{column} = ?" for column, _ in conditions) if conditions else ""
+        with self._lock:
+            return pd.read_sql_query(query + where + suffix, self._connection,
+                                     params=[value for _, value in conditions])
+
+    def files(self, region: Optional[str] = None, country: Optional[str] = None,
+              language: Optional[str] = None) -> pd.DataFrame:
+        """One row per file, paths relative to root"""
+        return self._select("SELECT * FROM files", region, country, language, " ORDER BY path")
+
+    def partitions(self, region: Optional[str] = None, country: Optional[str] = None,
+                   language: Optional[str] = None) -> pd.DataFrame:
+        """One row per region/country/language with its number of files and the sums of their counts"""
+        sums = ", ".join(f"SUM({column}) AS {column}" for column in COUNT_COLUMNS)
+        return self._select(f"SELECT region, country, language, COUNT(*) AS files, {sums} FROM files", region,
+                            country, language, " GROUP BY region, country, language ORDER BY region, country, language")
+
+    def words(self, region: Optional[str] = None, country: Optional[str] = None,
+              language: Optional[str] = None) -> int:
+        """Number of words of the files selected"""
+        return int(self._select("SELECT COALESCE(SUM(words), 0) AS words FROM files", region, country,
+                                language)["words"].iloc[0])
+
+    def file_words(self, path: Union[str, os.PathLike]) -> Optional[int]:
+        """Number of words of one file, None if the manifest does not know it"""
+        with self._lock:
+            row = self._connection.execute("SELECT words FROM files WHERE path = ?",
+                                           (self._relative(path),)).fetchone()
+        return None if row is None else row[0]
+
+    def scan(self, corpus_format: str = "csv", workers: Optional[int] = None) -> int:
+        """Count the files under root that are new or changed since they were recorded, workers files at a time,
+        and forget the ones that are gone. Returns the number of files counted"""
+        with self._lock:
+            known = {path: (size, mtime) for path, size, mtime in
+                     self._connection.execute("SELECT path, bytes, mtime FROM files").fetchall()}
+        found = set()
+        tasks = []
+        for region in list_regions(self.root, corpus_format):
+            for country, language in list_partitions(self.root, region, corpus_format):
+                for path in corpus_files(partition_dir(self.root, region, country, language, corpus_format),
+                                         corpus_format):
+                    relative = self._relative(path)
+                    found.add(relative)
+                    if known.get(relative) != (os.path.getsize(path), os.path.getmtime(path)):
+                        tasks.append((path, region, country, language))
+        self.remove(os.path.join(self.root, path) for path in set(known) - found)
+        if tasks:
+            with mp.Pool(processes=workers) as pool:
+                stats = pool.map(file_stats, [path for path, _, _, _ in tasks], chunksize=1)
+            self.add_many((*task, stat) for task, stat in zip(tasks, stats))
+        return len(tasks)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
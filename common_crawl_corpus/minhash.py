@@ -0,0 +1,91 @@
+from typing import Sequence
+
+import numpy as np
+
+_SHINGLE_BASE = np.uint64(1000003)
+
+
+def _mix64(values: np.ndarray) -> np.ndarray:
+    """splitmix64 finalizer, spreads the bits of uint64 values (wrapping arithmetic)"""
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xBF58476D1CE4E5B9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+class MinHasher(object):
+    """MinHash signatures and LSH band keys of lines, computed with NumPy over whole batches of lines.
+
+    A line is the set of its shingle_size character shingles (characters rather than words, so that scripts without
+    spaces work the same). Its signature holds, for num_perm random permutations, the smallest permuted shingle
+    hash; two lines agree on a signature value with probability equal to the Jaccard similarity of their shingles.
+    Signatures are cut into bands of num_perm // bands values and every band is reduced to one 64 bit key: lines
+    sharing any key are near-duplicates, which with the defaults (16 bands of 8) catches pairs above a Jaccard
+    similarity of about 0.7. Only the keys need to be kept to check later lines against earlier ones.
+    """
+
+    def __init__(self, num_perm: int = 128, bands: int = 16, shingle_size: int = 5, seed: int = 1,
+                 max_shingles: int = 2 ** 16):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_size = shingle_size
+        # Shingles are permuted max_shingles at a time, this bounds the memory used to max_shingles * num_perm * 8
+        self.max_shingles = max_shingles
+        # Multiply-shift hashing, (a * h + b mod 2^64) >> 32 with a odd: as good as the usual modulo a Mersenne
+        # prime for MinHash and several times faster in NumPy
+        generator = np.random.default_rng(seed)
+        self._a = generator.integers(0, 1 << 63, num_perm, dtype=np.uint64)[:, None] * np.uint64(2) + np.uint64(1)
+        self._b = generator.integers(0, 1 << 63, num_perm, dtype=np.uint64)[:, None]
+
+    def _shingle_hashes(self, lines: Sequence[str]):
+        """32 bit hashes of the shingles of all lines, and the number of shingles of each line. Lines are padded so
+        that lines shorter than a shingle still have one"""
+        padding = "\0" * self.shingle_size
+        codes = np.frombuffer(padding.join(lines).encode("utf-32-le") + padding.encode("utf-32-le"),
+                              dtype=np.uint32).astype(np.uint64)
+        lengths = np.fromiter(map(len, lines), dtype=np.int64, count=len(lines))
+        counts = np.maximum(lengths - self.shingle_size + 1, 1)
+        line_starts = np.concatenate(([0], np.cumsum(lengths + self.shingle_size)[:-1]))
+        starts = np.repeat(line_starts, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        hashes = np.zeros(len(starts), dtype=np.uint64)
+        for offset in range(self.shingle_size):
+            hashes = hashes * _SHINGLE_BASE + codes[starts + offset]
+        return _mix64(hashes) >> np.uint64(32), counts
+
+    def signatures(self, lines: Sequence[str]) -> np.ndarray:
+        """MinHash signatures of the lines, an array of shape (len(lines), num_perm) of uint32"""
+        signatures = np.empty((len(lines), self.num_perm), dtype=np.uint32)
+        if not len(lines):
+            return signatures
+        hashes, counts = self._shingle_hashes(lines)
+        ends = np.cumsum(counts)
+        first_line = 0
+        while first_line < len(lines):
+            # Group whole lines up to max_shingles shingles (at least one line)
+            start = ends[first_line] - counts[first_line]
+            last_line = max(first_line + 1, int(np.searchsorted(ends, start + self.max_shingles, side="right")))
+            group = hashes[start:ends[last_line - 1]]
+            permuted = self._a * group
+            permuted += self._b
+            permuted >>= np.uint64(32)
+            offsets = (ends[first_line:last_line] - counts[first_line:last_line]) - start
+            signatures[first_line:last_line] = np.minimum.reduceat(permuted, offsets, axis=1).T
+            first_line = last_line
+        return signatures
+
+    def band_keys(self, signatures: np.ndarray) -> np.ndarray:
+        """LSH key of every band of the signatures, shape (len(signatures), bands) of uint64. Keys include the band
+        number, so the keys of all bands can go in one set"""
+        rows = signatures.reshape(len(signatures), self.bands, -1).astype(np.uint64)
+        keys = np.broadcast_to(np.arange(1, self.bands + 1, dtype=np.uint64), rows.shape[:2]) * np.uint64(
+            0x9E3779B97F4A7C15)
+        for row in range(rows.shape[2]):
+            keys = _mix64(keys ^ rows[:, :, row])
+        return keys
+
+    def line_keys(self, lines: Sequence[str]) -> np.ndarray:
+        """band_keys of the signatures of the lines"""
+        return self.band_keys(self.signatures(lines))
@@ -11,6 +11,8 @@ from functools import partial
 import re
 import string
 import shutil
+from common_crawl_corpus.corpus_store import CORPUS_EXTENSIONS, partition_dir
+from common_crawl_corpus.manifest import CorpusManifest
 #from corpus_similarity.corpus_similarity import Similarity
 
 from gensim.models import FastText
@@ -122,6 +124,13 @@ def seq_outliers(df, model, region, country, language, id):
     
     return df    
 
+#---------------------------------------------------------------
+def original_name(file):
+
+    #e.g. x.clean.1.gz -> x.clean.1.original.gz, x.clean.1.parquet -> x.clean.1.original.parquet
+    root, extension = os.path.splitext(file)
+    return root + ".original" + extension
+
 #---------------------------------------------------------------
 def process_file(test_file, sample_size=1000):
 
@@ -135,9 +144,29 @@ def process_file(test_file, sample_size=1000):
     #Only use cleaned files
     if ".clean." in file:
     
-        #Load and aggregate into samples
         print(file)
-        df = pd.read_csv(os.path.join(PATH_TO_CCGLU, region, country, language, file), index_col = 0)
+
+        #Path of the file in the corpus, csv or parquet layout (see corpus_store)
+        corpus_format = "parquet" if file.endswith(CORPUS_EXTENSIONS["parquet"]) else "csv"
+        source = os.path.join(partition_dir(PATH_TO_CCGLU, region, country, language, corpus_format), file)
+
+        #The corpus manifest has the words of each file, keyed by this path; small ones are copied without loading them
+        manifest_words = None
+        if os.path.exists(os.path.join(PATH_TO_CCGLU, "manifest.sqlite")):
+            manifest = CorpusManifest(PATH_TO_CCGLU)
+            manifest_words = manifest.file_words(source)
+            manifest.close()
+        if manifest_words is not None and manifest_words < 5000000:
+            print("Need at least 5 million words", file)
+            os.makedirs(os.path.join("..", "CGLU_TWGLU", "CGLU_Outliers", region, country, language), exist_ok = True)
+            shutil.copyfile(source, os.path.join("..", "CGLU_TWGLU", "CGLU_Outliers", region, country, language, original_name(file)))
+            return
+
+        #Load and aggregate into samples
+        if corpus_format == "parquet":
+            df = pd.read_parquet(source)
+        else:
+            df = pd.read_csv(source, index_col = 0)
         df.reset_index(drop=True, inplace=True)
         print("\tNumber of words ", df.loc[:,"N_Words"].sum(), file)
         os.makedirs(os.path.join("..", "CGLU_TWGLU", "CGLU_Outliers", region, country, language), exist_ok = True)
@@ -146,7 +175,7 @@ def process_file(test_file, sample_size=1000):
         #Need a million words
         if original_length < 5000000:
             print("Need at least 5 million words", file)
-            shutil.copyfile(os.path.join(PATH_TO_CCGLU, region, country, language, file), os.path.join("..", "CGLU_TWGLU", "CGLU_Outliers", region, country, language, file.replace(".gz",".original.gz")))
+            shutil.copyfile(source, os.path.join("..", "CGLU_TWGLU", "CGLU_Outliers", region, country, language, original_name(file)))
             
         else:
         
@@ -0,0 +1,104 @@
+import os
+from typing import Dict, Iterable, List, Tuple, Union
+
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from .hashing import hash_lines
+
+# Columns of a processed segment, in the order of the tuples built by CC_Corpus._process_wet_content.
+# Domain, Country and URL repeat for every line of a page and are dictionary encoded: each distinct value is stored
+# once per file and the lines only keep a fixed-width index to it. pandas reads them back as categoricals.
+SEGMENT_SCHEMA = pa.schema([
+    ("Domain", pa.dictionary(pa.int16(), pa.string())),
+    ("Country", pa.dictionary(pa.int16(), pa.string())),
+    ("URL", pa.dictionary(pa.int32(), pa.string())),
+    ("LineID", pa.int32()),
+    ("Text", pa.string()),
+    ("Hash", pa.uint64()),
+])
+
+
+def read_segment(path: Union[str, os.PathLike]) -> pa.Table:
+    """Read a processed segment, combined or deduplicated file as an Arrow table in SEGMENT_SCHEMA. Files written
+    before the columns were dictionary encoded are converted on the fly, their per-process hash() values are
+    replaced by hashing.line_hash so they can be deduplicated together with new files."""
+    table = feather.read_table(path)
+    if not table.schema.equals(SEGMENT_SCHEMA):
+        if table.schema.field("Hash").type != SEGMENT_SCHEMA.field("Hash").type:
+            text = table.column("Text").to_pylist()
+            table = table.set_column(table.schema.get_field_index("Hash"), "Hash", pa.array(hash_lines(text)))
+        table = table.cast(SEGMENT_SCHEMA)
+    return table
+
+
+def write_segment(table: pa.Table, path: Union[str, os.PathLike], compression: str = "lz4"):
+    """Write a table in SEGMENT_SCHEMA to path, under a temporary name first so that path is always complete"""
+    feather.write_feather(table.unify_dictionaries(), f"{path}.tmp", compression=compression)
+    os.replace(f"{path}.tmp", path)
+
+
+class SegmentWriter(object):
+    """
+    Writes the processed lines of a segment to a feather (Arrow IPC) file as they come, rows_per_batch lines per
+    record batch, so memory stays flat however large the segment is. The file is written under a temporary name
+    and only moved in place by close(); leaving the with block on an exception discards it.
+    e.g.
+        with SegmentWriter(path) as writer:
+            writer.write(lines)
+    """
+
+    def __init__(self, path: Union[str, os.PathLike], rows_per_batch: int = 2 ** 16, compression: str = "lz4"):
+        self.path = path
+        self.rows_per_batch = rows_per_batch
+        self.rows = 0
+        self._buffer: List[Tuple] = []
+        # Value -> index of the dictionary encoded columns, shared by all batches of the file. A batch only appends
+        # to them, so the writer stores each new batch of values as a dictionary delta
+        self._dictionaries: Dict[str, Dict[str, int]] = {field.name: {} for field in SEGMENT_SCHEMA
+                                                         if pa.types.is_dictionary(field.type)}
+        self._tmp_path = f"{path}.tmp"
+        self._writer = pa.ipc.new_file(self._tmp_path, SEGMENT_SCHEMA,
+                                       options=pa.ipc.IpcWriteOptions(compression=compression,
+                                                                      emit_dictionary_deltas=True))
+
+    def write(self, lines: Iterable[Tuple[str, str, str, int, str, int]]):
+        self._buffer.extend(lines)
+        if len(self._buffer) >= self.rows_per_batch:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        columns = zip(*self._buffer)
+        self._writer.write_batch(pa.RecordBatch.from_arrays(
+            [self._to_array(column, field) for column, field in zip(columns, SEGMENT_SCHEMA)],
+            schema=SEGMENT_SCHEMA))
+        self.rows += len(self._buffer)
+        self._buffer = []
+
+    def _to_array(self, column: Tuple, field: pa.Field) -> pa.Array:
+        if not pa.types.is_dictionary(field.type):
+            return pa.array(column, type=field.type)
+        dictionary = self._dictionaries[field.name]
+        indices = [dictionary.setdefault(value, len(dictionary)) for value in column]
+        return pa.DictionaryArray.from_arrays(pa.array(indices, type=field.type.index_type),
+                                              pa.array(list(dictionary), type=field.type.value_type))
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._writer.close()
+        os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
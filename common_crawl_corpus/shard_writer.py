@@ -0,0 +1,119 @@
+import gzip
+import os
+from typing import Dict, Iterable, List, Set, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .corpus_store import CORPUS_EXTENSIONS, PARQUET_OPTIONS, ROW_GROUP_SIZE, merge_stats, read_batches, table_stats
+from .hashing import hash_lines
+
+
+class ShardWriter(object):
+    """
+    Writes rows to shards of shard_size rows, directory/prefix.1.gz, directory/prefix.2.gz, ... as they come; only
+    the last shard may be smaller. Shards are gzipped csv or, with corpus_format="parquet", parquet files
+    (prefix.1.parquet, ...) in the format of corpus_store. Rows go straight to the compressed file, memory use is
+    that of the table passed to write whatever the shard size. Each shard is written under a temporary name and moved
+    in place once complete; leaving the with block on an exception discards the shard in progress. The counts of each
+    shard written (see corpus_store.table_stats) are in shard_stats, for the corpus manifest.
+    e.g.
+        with ShardWriter(os.path.join(output_dir, region, country, language), "europe_west.fr.fra") as writer:
+            for batch in read_batches(path):
+                writer.write(pa.Table.from_batches([batch]))
+    """
+
+    def __init__(self, directory: Union[str, os.PathLike], prefix: str, shard_size: int = 100000,
+                 corpus_format: str = "csv"):
+        self.directory = directory
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.corpus_format = corpus_format
+        self.rows = 0
+        self.shards: List[str] = []
+        self.shard_stats: List[Dict[str, Union[int, str, None]]] = []
+        self._file = None
+        self._shard_rows = 0
+        self._stats: List[Dict[str, Union[int, str, None]]] = []
+
+    def _shard_path(self) -> str:
+        return os.path.join(self.directory,
+                            f"{self.prefix}.{len(self.shards) + 1}{CORPUS_EXTENSIONS[self.corpus_format]}")
+
+    def write(self, table: pa.Table):
+        offset = 0
+        while offset < len(table):
+            if self._file is None:
+                os.makedirs(self.directory, exist_ok=True)
+                if self.corpus_format == "parquet":
+                    self._file = pq.ParquetWriter(f"{self._shard_path()}.tmp", table.schema, **PARQUET_OPTIONS)
+                else:
+                    self._file = gzip.open(f"{self._shard_path()}.tmp", "wt", encoding="utf-8", newline="")
+            size = min(self.shard_size - self._shard_rows, len(table) - offset)
+            rows = table.slice(offset, size)
+            if self.corpus_format == "parquet":
+                self._file.write_table(rows, row_group_size=ROW_GROUP_SIZE)
+            else:
+                rows.to_pandas().to_csv(self._file, header=not self._shard_rows, index=False, index_label=False)
+            self._stats.append(table_stats(rows))
+            self._shard_rows += size
+            offset += size
+            if self._shard_rows == self.shard_size:
+                self.flush()
+
+    def flush(self):
+        """Complete the shard in progress, the next rows start a new one"""
+        if self._file is None:
+            return
+        self._file.close()
+        path = self._shard_path()
+        os.replace(f"{path}.tmp", path)
+        self.shards.append(path)
+        self.shard_stats.append(merge_stats(self._stats))
+        self.rows += self._shard_rows
+        self._file = None
+        self._shard_rows = 0
+        self._stats = []
+
+    def close(self):
+        self.flush()
+
+    def abort(self):
+        if self._file is not None:
+            self._file.close()
+            os.remove(f"{self._shard_path()}.tmp")
+            self._file = None
+            self._stats = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def merge_partition(files: Iterable[Union[str, os.PathLike]], directory: Union[str, os.PathLike], prefix: str,
+                    shard_size: int = 100000, block_size: int = 2 ** 24,
+                    corpus_format: str = "csv") -> Tuple[int, List[str], List[Dict[str, Union[int, str, None]]]]:
+    """Stream the pages of files (csv or parquet) into shards of shard_size pages in corpus_format, keeping the first
+    page of every URL. Files are read block_size bytes at a time and the URLs seen so far are kept as a set of 64-bit
+    hashes, so memory grows with the block size and the number of distinct URLs only, and time with the size of the
+    input. Returns the number of pages read, the shards written and their counts"""
+    seen: Set[int] = set()
+    pages = 0
+    with ShardWriter(directory, prefix, shard_size, corpus_format) as writer:
+        for path in files:
+            for batch in read_batches(path, block_size):
+                pages += batch.num_rows
+                hashes = hash_lines(batch.column("URL").fill_null("").to_pylist())
+                keep = ~pd.Series(hashes).duplicated(keep="first").to_numpy()
+                keep[keep] = np.fromiter((value not in seen for value in hashes[keep].tolist()), dtype=bool,
+                                         count=int(keep.sum()))
+                seen.update(hashes[keep].tolist())
+                writer.write(pa.Table.from_batches([batch]).filter(pa.array(keep)))
+    return pages, writer.shards, writer.shard_stats
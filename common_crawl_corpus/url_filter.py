@@ -0,0 +1,102 @@
+import logging
+import os
+from typing import Iterable, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from tldextract.remote import lenient_netloc
+
+from . import utilities
+
+logger = logging.getLogger(__name__)
+
+
+class UrlFilter(object):
+    """
+    Filter of multinational websites, pages whose site repeats the same content in many countries.
+
+    Entries are compiled into hashed sets once: a bare name such as 'hotel' matches the registered domain of a url
+    whatever its suffix (hotel.fr, www.hotel.de), an entry with a dot such as 'shop.example.co.uk' matches that host
+    and all of its subdomains. Entries come from domains (utilities.URL_FILTER by default) and from the files written
+    by utilities.write_url_filters_to_file. reload() re-reads the files when they changed on disk, so a running
+    crawl picks up a new list between chunks.
+    e.g.
+        url_filter = UrlFilter(files=["url_filter.txt"])
+        url_filter.is_filtered("https://www.hotel.fr/room")
+        df = df[~url_filter.mask(df["URL"])]
+    """
+
+    def __init__(self, domains: Iterable[str] = utilities.URL_FILTER,
+                 files: Sequence[Union[str, os.PathLike]] = ()):
+        self.domains = tuple(domains)
+        self.files = tuple(files)
+        self._mtimes: Tuple[Optional[float], ...] = ()
+        self.names = frozenset()
+        self.hosts = frozenset()
+        self.reload(force=True)
+
+    def __len__(self) -> int:
+        return len(self.names) + len(self.hosts)
+
+    def _file_mtimes(self) -> Tuple[Optional[float], ...]:
+        return tuple(os.path.getmtime(file) if os.path.exists(file) else None for file in self.files)
+
+    def reload(self, force: bool = False) -> bool:
+        """Compile the entries again if one of the files changed since the last load, return True if it did"""
+        mtimes = self._file_mtimes()
+        if not force and mtimes == self._mtimes:
+            return False
+        entries = set(self.domains)
+        for file, mtime in zip(self.files, mtimes):
+            if mtime is not None:
+                entries.update(str(entry) for entry in utilities.get_url_filters_from_file(file).keys())
+        entries = {entry.strip().lower().strip(".") for entry in entries} - {""}
+        self.names = frozenset(entry for entry in entries if "." not in entry)
+        self.hosts = frozenset(entry for entry in entries if "." in entry)
+        self._mtimes = mtimes
+        logger.debug(f'UrlFilter: loaded {len(self.names)} domain names and {len(self.hosts)} hosts')
+        return True
+
+    def _host_filtered(self, host: str) -> bool:
+        """True if the host or one of its parent domains is a host entry"""
+        host = host.lower()
+        while True:
+            if host in self.hosts:
+                return True
+            _, dot, host = host.partition(".")
+            if not dot:
+                return False
+
+    def is_filtered(self, url: str, domain: Optional[str] = None) -> bool:
+        """True if the url belongs to a filtered site, domain is the registered domain of the url if already known
+        (as given by utilities.extract_url)"""
+        if domain is None:
+            domain, _ = utilities.extract_url(url)
+        if domain in self.names:
+            return True
+        return bool(self.hosts) and self._host_filtered(lenient_netloc(url))
+
+    def _unique_mask(self, urls: pa.Array) -> np.ndarray:
+        return np.fromiter((url is not None and self.is_filtered(url) for url in urls.to_pylist()),
+                           dtype=bool, count=len(urls))
+
+    def mask(self, urls: Union[pd.Series, pa.Array, pa.ChunkedArray, Sequence[str]]) -> np.ndarray:
+        """Boolean array over a column of urls, True for the rows to drop. Each distinct url is only looked at once:
+        dictionary encoded columns (processed segments, categoricals) are matched on their dictionary"""
+        if isinstance(urls, pd.Series):
+            urls = pa.Array.from_pandas(urls)
+        elif not isinstance(urls, (pa.Array, pa.ChunkedArray)):
+            urls = pa.array(urls, type=pa.string())
+        chunks = urls.chunks if isinstance(urls, pa.ChunkedArray) else [urls]
+        masks = []
+        for chunk in chunks:
+            if not pa.types.is_dictionary(chunk.type):
+                chunk = pc.dictionary_encode(chunk)
+            if not len(chunk.dictionary):
+                masks.append(np.zeros(len(chunk), dtype=bool))
+                continue
+            indices = chunk.indices.fill_null(0).to_numpy(zero_copy_only=False)
+            masks.append(self._unique_mask(chunk.dictionary)[indices] & chunk.is_valid().to_numpy(zero_copy_only=False))
+        return np.concatenate(masks) if masks else np.zeros(0, dtype=bool)
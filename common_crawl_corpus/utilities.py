@@ -1,7 +1,9 @@
-from typing import Dict
+from typing import Dict, Optional, Tuple
 import csv
+import functools
 import emoji
 import tldextract
+from tldextract.remote import lenient_netloc
 import nltk
 import re
 import pandas as pd
@@ -72,7 +74,7 @@ COUNTRY_CODES_NAME: Dict[str, str] = {
     "台灣": "Taiwan", "新加坡": "Singapore", "澳門": "Macao", "香港": "Hong_Kong", "한국": "South_Korea"
 }
 
-COUNTRY_CODES_REGION: typing.Dict[str, str] = {
+COUNTRY_CODES_REGION: Dict[str, str] = {
     "ad": "europe_west", "ae": "middle_east", "af": "asia_central", "al": "europe_west", "ao": "africa_sub",
     "aq": "antarctica", "ar": "america_south", "as": "asia_southeast",
     "at": "europe_west", "au": "oceania", "aw": "america_central", "ax": "europe_west", "az": "asia_central",
@@ -223,9 +225,88 @@ def remove_emoji(text: str):
     return emoji.replace_emoji(text, replace='')
 
 
+class UrlCache(object):
+    """
+    Memoized url -> (domain, country code) resolution. Results are kept in a bounded LRU keyed by host, since the
+    same hosts come back all the time within a segment and across a crawl. country() only needs the last label of
+    the host: hosts not under one of country_codes are rejected without calling tldextract. hits / misses / rejected
+    are exposed through stats().
+    """
+
+    def __init__(self, country_codes=COUNTRY_CODES_NAME, maxsize: int = 2 ** 16):
+        self.country_codes = frozenset(country_codes)
+        self.rejected = 0
+        self._extract_host = functools.lru_cache(maxsize=maxsize)(self._extract)
+
+    @staticmethod
+    def _extract(host: str) -> Tuple[str, str]:
+        _, domain, suffix = tldextract.extract(host)
+        return domain, suffix.split('.')[-1]
+
+    def extract(self, url: str) -> Tuple[str, str]:
+        """Registered domain and last label of the public suffix of the url, as tldextract gives them"""
+        return self._extract_host(lenient_netloc(url))
+
+    def country(self, url: str) -> str:
+        """Country code of the url as extract() gives it, "" if its host is not under one of country_codes"""
+        host = lenient_netloc(url)
+        # same label split as tldextract, including ideographic full stops
+        label = host.replace("\u3002", ".").replace("\uff0e", ".").replace("\uff61", ".").rpartition(".")[-1]
+        if label not in self.country_codes:
+            self.rejected += 1
+            return ""
+        return self._extract_host(host)[1]
+
+    def stats(self) -> Dict[str, int]:
+        info = self._extract_host.cache_info()
+        return {"hits": info.hits, "misses": info.misses, "rejected": self.rejected, "size": info.currsize}
+
+    def clear(self):
+        self._extract_host.cache_clear()
+        self.rejected = 0
+
+
+# Shared by CC_Corpus and WET_processor through extract_url
+url_cache = UrlCache()
+
+
 def extract_url(url: str):
-    _, domain, suffix = tldextract.extract(url)
-    return domain, suffix.split('.')[-1]
+    return url_cache.extract(url)
+
+
+def url_country(url: str) -> str:
+    return url_cache.country(url)
+
+
+def read_wet_content(wet_record, max_bytes: Optional[int] = None) -> str:
+    """
+    Read and decode the text of a wet record. With max_bytes, at most that many bytes of the page are read and
+    decoded, cut back to the last complete line; the rest of the payload is left for ArchiveIterator to skip
+    """
+    stream = wet_record.content_stream()
+    if max_bytes is None:
+        return stream.read().decode("utf-8")
+    chunks = []
+    remaining = max_bytes + 1
+    while remaining > 0 and (chunk := stream.read(remaining)):
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return decode_wet_content(b"".join(chunks), max_bytes)
+
+
+def decode_wet_content(content, max_bytes: Optional[int] = None) -> str:
+    """Decode the payload of a wet record (bytes or a memoryview of them), with max_bytes at most that many bytes
+    cut back to the last complete line"""
+    if max_bytes is not None and len(content) > max_bytes:
+        content = bytes(content[:max_bytes])
+        content = content[:content.rfind(b"\n") + 1]
+    return str(content, "utf-8")
+
+
+def wet_content_length(wet_record) -> Optional[int]:
+    """Payload size declared in the Content-Length header of a wet record, None if missing"""
+    length = wet_record.rec_headers.get_header("Content-Length")
+    return int(length) if length is not None and length.isdigit() else None
 
 
 def extract_n_grams(text: str, n: int = 1):
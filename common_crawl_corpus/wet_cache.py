@@ -0,0 +1,163 @@
+import io
+import os
+import sqlite3
+import threading
+import time
+from typing import BinaryIO, Dict, Optional, Union
+
+from .downloader import Downloader, ResumableStream
+
+
+class WetCache(object):
+    """
+    Local mirror of the WET segments read so far, so that processing a crawl again (e.g. with new cleaning rules or
+    filters) reads them from disk instead of downloading them again.
+
+    Segments are stored under root with their Common Crawl path (root/crawl-data/CC-MAIN-.../...warc.wet.gz) and
+    registered in root/cache.sqlite with their size, ETag and last use. A missing segment is written to the cache
+    while it is being read from the network, it only enters the cache once read completely. When the cache grows
+    over max_bytes, the least recently used segments are removed. With validate, a hit is first checked against the
+    size and ETag announced by the server.
+    e.g.
+        cache = WetCache("./common_crawl_download/wet_cache", Downloader(), max_bytes=500 * 2 ** 30)
+        with cache.open("crawl-data/CC-MAIN-2022-40/segments/.../CC-MAIN-...warc.wet.gz") as stream:
+            for record in ArchiveIterator(stream):
+                ...
+    """
+
+    def __init__(self, root: Union[str, os.PathLike], downloader: Optional[Downloader] = None,
+                 max_bytes: Optional[int] = None, validate: bool = False):
+        self.root = root
+        self.downloader = downloader or Downloader()
+        self.max_bytes = max_bytes
+        self.validate = validate
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(root, "cache.sqlite"), check_same_thread=False, timeout=60)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS segments ("
+                                     "segment TEXT PRIMARY KEY, "
+                                     "size INTEGER NOT NULL, "
+                                     "etag TEXT, "
+                                     "last_used REAL NOT NULL)")
+
+    def path(self, segment: str) -> str:
+        """Local path of a segment in the cache"""
+        return os.path.join(self.root, segment.strip().lstrip("/"))
+
+    def _entry(self, segment: str):
+        with self._lock:
+            return self._connection.execute("SELECT size, etag FROM segments WHERE segment = ?",
+                                            (segment,)).fetchone()
+
+    def _is_valid(self, segment: str) -> bool:
+        entry = self._entry(segment)
+        path = self.path(segment)
+        if entry is None or not os.path.exists(path) or os.path.getsize(path) != entry[0]:
+            return False
+        if self.validate:
+            size, etag = self.downloader.head(segment)
+            return size in (None, entry[0]) and (etag is None or entry[1] is None or etag == entry[1])
+        return True
+
+    def open(self, segment: str) -> BinaryIO:
+        """Binary stream of a segment, from the cache if it is there and from the network otherwise"""
+        segment = segment.strip()
+        if self._is_valid(segment):
+            self.hits += 1
+            with self._lock, self._connection:
+                self._connection.execute("UPDATE segments SET last_used = ? WHERE segment = ?", (time.time(), segment))
+            return open(self.path(segment), "rb")
+        self.misses += 1
+        self.remove(segment)
+        return _CachingStream(self, segment, self.downloader.open(segment))
+
+    def fetch(self, segment: str) -> str:
+        """Local path of a segment, downloaded into the cache first if it is not there"""
+        with self.open(segment) as stream:
+            if isinstance(stream, _CachingStream):
+                while stream.read(self.downloader.chunk_size):
+                    pass
+        return self.path(segment.strip())
+
+    def contains(self, segment: str) -> bool:
+        return self._entry(segment.strip()) is not None
+
+    def _add(self, segment: str, size: int, etag: Optional[str]):
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO segments (segment, size, etag, last_used) "
+                                     "VALUES (?, ?, ?, ?)", (segment, size, etag, time.time()))
+        self.evict(keep=segment)
+
+    def remove(self, segment: str):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM segments WHERE segment = ?", (segment,))
+        if os.path.exists(self.path(segment)):
+            os.remove(self.path(segment))
+
+    def size(self) -> int:
+        """Bytes used by the cached segments"""
+        with self._lock:
+            return self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM segments").fetchone()[0]
+
+    def evict(self, keep: Optional[str] = None):
+        """Remove the least recently used segments until the cache fits in max_bytes"""
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            entries = self._connection.execute("SELECT segment, size FROM segments ORDER BY last_used").fetchall()
+        total = sum(size for _, size in entries)
+        for segment, size in entries:
+            if total <= self.max_bytes:
+                break
+            if segment != keep:
+                self.remove(segment)
+                total -= size
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "bytes": self.size()}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class _CachingStream(io.RawIOBase):
+    """Reads a segment from the network and writes it to the cache as it goes, the copy is kept only if the segment
+    was read to the end"""
+
+    def __init__(self, cache: WetCache, segment: str, stream: ResumableStream):
+        super().__init__()
+        self.cache = cache
+        self.segment = segment
+        self.stream = stream
+        self._path = cache.path(segment)
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        self._file = open(f"{self._path}.part", "wb")
+        self._complete = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = self.stream.readinto(buffer)
+        if size:
+            self._file.write(memoryview(buffer)[:size])
+        else:
+            self._complete = True
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.stream.close()
+            self._file.close()
+            size = os.path.getsize(f"{self._path}.part")
+            if self._complete and (self.stream.total is None or size == self.stream.total):
+                os.replace(f"{self._path}.part", self._path)
+                self.cache._add(self.segment, size, self.stream.etag)
+            else:
+                os.remove(f"{self._path}.part")
+        super().close()
@@ -0,0 +1,95 @@
+import mmap
+import os
+import zlib
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+# ID1, ID2 and CM (deflate) of a gzip member header
+GZIP_MAGIC = b"\x1f\x8b\x08"
+# Enough compressed bytes to get past a member header and decode the start of the record
+_PROBE_SIZE = 4096
+# Compressed bytes handed to zlib at a time, about the size of a compressed WET record
+_INFLATE_SIZE = 2 ** 15
+
+
+def is_member_start(buffer, offset: int) -> bool:
+    """True if a gzip member holding a WARC record starts at offset. Common Crawl writes every record of a WET file
+    as its own gzip member, so the magic bytes followed by data that inflates to 'WARC/' mark a record boundary"""
+    if buffer[offset:offset + len(GZIP_MAGIC)] != GZIP_MAGIC:
+        return False
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    try:
+        return decompressor.decompress(buffer[offset:offset + _PROBE_SIZE], 5) == b"WARC/"
+    except zlib.error:
+        return False
+
+
+def find_member(buffer, offset: int, end: int) -> int:
+    """Offset of the first member boundary at or after offset, end if there is none before end"""
+    while (offset := buffer.find(GZIP_MAGIC, offset, end)) >= 0:
+        if is_member_start(buffer, offset):
+            return offset
+        offset += 1
+    return end
+
+
+def member_ranges(path: Union[str, os.PathLike], parts: int) -> List[Tuple[int, int]]:
+    """Split a WET file into at most parts byte ranges of about the same size that start and end on record
+    boundaries, so that each range can be decompressed and parsed on its own. A file that is not a multi-member
+    gzip of WARC records is a single range"""
+    size = os.path.getsize(path)
+    if not size:
+        return []
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        if parts <= 1 or not is_member_start(buffer, 0):
+            return [(0, size)]
+        starts = sorted({0} | {find_member(buffer, size * part // parts, size) for part in range(1, parts)} - {size})
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def parse_records(data: bytes) -> Iterator[Tuple[Dict[str, str], memoryview]]:
+    """Headers and payload of the WARC records in a block of uncompressed data, one or more records as written one
+    after the other. The payloads are views of data, they are only copied once decoded"""
+    view = memoryview(data)
+    position = 0
+    while position < len(data):
+        header_end = data.find(b"\r\n\r\n", position)
+        if header_end < 0 or not data.startswith(b"WARC/", position):
+            raise ValueError(f"no WARC record at byte {position}")
+        header_block = data[position:header_end]
+        try:
+            header_block = header_block.decode("utf-8")
+        except UnicodeDecodeError:
+            # As warcio does for headers that are not utf-8
+            header_block = header_block.decode("iso-8859-1")
+        headers = {}
+        for line in header_block.split("\r\n")[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip()] = value.strip()
+        payload_start = header_end + 4
+        position = payload_start + int(headers.get("Content-Length", 0))
+        yield headers, view[payload_start:position]
+        # Records are followed by an empty line
+        while data.startswith(b"\r\n", position):
+            position += 2
+
+
+def iter_records(buffer, start: int = 0, end: Optional[int] = None) -> Iterator[Tuple[Dict[str, str], memoryview]]:
+    """Headers and payload of the records of a gzipped WARC file between start and end, e.g. one of member_ranges()
+    of a memory-mapped WET file. Members are inflated straight from the buffer one at a time, so memory use is
+    that of one record whatever the size of the file"""
+    view = memoryview(buffer)
+    end = len(view) if end is None else end
+    try:
+        while start < end:
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            blocks = []
+            while not decompressor.eof and start < end:
+                with view[start:min(start + _INFLATE_SIZE, end)] as chunk:
+                    blocks.append(decompressor.decompress(chunk))
+                    start += len(chunk)
+            if not decompressor.eof:
+                raise ValueError(f"truncated gzip member before byte {end}")
+            start -= len(decompressor.unused_data)
+            yield from parse_records(b"".join(blocks))
+    finally:
+        view.release()